@@ -1,18 +1,67 @@
 import fire
 import mutagen
+import mutagen.aiff
+import mutagen.apev2
+import mutagen.flac
+import mutagen.ogg
 import urllib.request
 import json
 import os
-import glob
 import sys
+import codecs
+import shutil
+import base64
+import hashlib
+import io
+import time
+import queue
+import threading
+import socket
+import mmap
+import sqlite3
+import subprocess
+from collections import deque
 import regex as re
 from urllib.parse import urlparse
 from pprint import pprint
+from copy import deepcopy
 from functools import reduce
-from contextlib import suppress
+from itertools import groupby
+from collections.abc import MutableMapping
+from mutagen.easyid3 import EasyID3
+from mutagen.easymp4 import EasyMP4Tags
+from mutagen.id3 import APIC
+from mutagen.mp4 import MP4Cover
+from contextlib import suppress, contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathvalidate import sanitize_filename
 from discogs_tag import __NAME__, __VERSION__
 
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+try:
+  from inotify_simple import INotify, flags as inotify_flags
+except ImportError:
+  INotify = None
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
 SKIP_KEYS = [
   'artist',
   'composer',
@@ -29,12 +78,137 @@ COMPOSER_TAGS = r"(written|composed)[- ]by"
 
 VARIOUS_ARTISTS = 'Various Artists'
 
-AUDIO_EXTENSIONS = ['flac', 'mp3']
+AUDIO_EXTENSIONS = ['flac', 'mp3', 'm4a', 'ogg', 'opus', 'wv', 'aiff', 'aif']
+
+TAG_KEYS = [
+  'artist',
+  'albumartist',
+  'album',
+  'composer',
+  'discnumber',
+  'genre',
+  'tracknumber',
+  'title',
+  'date'
+]
+
+APEV2_KEYS = {
+  'artist': 'Artist',
+  'albumartist': 'Album Artist',
+  'album': 'Album',
+  'composer': 'Composer',
+  'discnumber': 'Disc',
+  'genre': 'Genre',
+  'tracknumber': 'Track',
+  'title': 'Title',
+  'date': 'Year'
+}
+
+# EasyMP4 does not map the composer out of the box.
+EasyMP4Tags.RegisterTextKey('composer', '\xa9wrt')
+
+# Cover art is exposed as a 'picture' key that accepts (data, mime) tuples and reads back the image types,
+# to keep image data out of tag listings.
+def id3_picture_get(id3, key):
+  frames = id3.getall('APIC')
+  if not frames:
+    raise KeyError(key)
+  return [frame.mime for frame in frames]
+
+def id3_picture_set(id3, key, value):
+  id3.delall('APIC')
+  for data, mime in value:
+    id3.add(APIC(encoding=3, mime=mime, type=3, desc='', data=data))
+
+def id3_picture_delete(id3, key):
+  id3.delall('APIC')
+
+def mp4_picture_get(tags, key):
+  return ['image/png' if cover.imageformat == MP4Cover.FORMAT_PNG else 'image/jpeg' for cover in tags['covr']]
+
+def mp4_picture_set(tags, key, value):
+  tags['covr'] = [MP4Cover(data, MP4Cover.FORMAT_PNG if mime == 'image/png' else MP4Cover.FORMAT_JPEG) for data, mime in value]
+
+def mp4_picture_delete(tags, key):
+  del tags['covr']
+
+EasyID3.RegisterKey('picture', id3_picture_get, id3_picture_set, id3_picture_delete)
+EasyMP4Tags.RegisterKey('picture', mp4_picture_get, mp4_picture_set, mp4_picture_delete)
 
 TITLE_SEPARATOR = ' / '
 
 NON_TITLE_SEPARATOR = ', '
 
+RELEASE_KEYS = [
+  'tracklist',
+  'artists',
+  'extraartists',
+  'genres',
+  'styles',
+  'year',
+  'title'
+]
+
+RELEASE_CHUNK_SIZE = 64 * 1024
+
+OUTPUT_FORMATS = ['json', 'jsonl', 'msgpack', 'table']
+
+ART_MODES = ['embed', 'folder']
+
+ART_TYPES = {
+  'image/jpeg': 'jpg',
+  'image/png': 'png'
+}
+
+ART_QUALITY = 90
+
+WATCH_SIDECARS = ['release.txt', 'discogs.txt', '.discogs']
+
+WATCH_FOLDER_RELEASE = r"\[r?(\d+)\]\s*$"
+
+WATCH_STATE = '.discogs-tag.json'
+
+BATCH_CHECKPOINT = '.discogs-tag.log'
+
+TAG_READERS = 8
+
+INDEX_FILE = 'index.sqlite'
+
+INDEX_CHUNK_SIZE = 16
+
+VERIFY_WINDOW = 64
+
+VERIFY_MAX_ERRORS = 10
+
+# Upper bound of the size of a FLAC frame header, subframe headers and footer, on top of verbatim samples.
+FLAC_FRAME_OVERHEAD = 64
+
+MASTER_WORKERS = 4
+
+# Discogs allows 25 unauthenticated requests per moving window of 60 seconds.
+DISCOGS_RATE_LIMIT = 25
+
+DISCOGS_RATE_WINDOW = 60
+
+RELEASE_CACHE_TTL = 7 * 24 * 3600
+
+MP3_BITRATES = {
+  (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+  (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+  (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+  (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+  (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+  (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+}
+
+MP3_SAMPLE_RATES = {
+  3: [44100, 48000, 32000],
+  2: [22050, 24000, 16000],
+  0: [11025, 12000, 8000]
+}
+
+STAGE_LOCK = threading.Lock()
+
 def version():
   """ Return version information. """
   print(json.dumps({
@@ -42,7 +216,7 @@ def version():
     'version': __VERSION__
   }, indent=4))
 
-def release(release):
+def release(release, raw=False, emit=None):
   """ Download the specified Discogs release as JSON.
 
   The RELEASE can be one of the following:
@@ -50,18 +224,49 @@ def release(release):
       - The numeric portion of the above, e.g. 16215626
       - A local file URI pointing to a release JSON file
 
+  The flag RAW streams the response to the output as-is, without parsing it.
+
+  The EMIT flag can take one of the following values:
+      json, jsonl, msgpack, table
+
+      The table format outputs one row per track.
+
   """
+  options = parse_options(locals())
   response = get_release(release)
+  if raw:
+    shutil.copyfileobj(response, sys.stdout.buffer, RELEASE_CHUNK_SIZE)
+    sys.stdout.buffer.flush()
+    return
   data = json.load(response)
-  print(json.dumps(data, indent=4))
+  if options['emit'] == 'table':
+    for track in data.get('tracklist', []):
+      emit_record({
+        'position': track.get('position', ''),
+        'title': track.get('title', ''),
+        'duration': track.get('duration', '')
+      }, options)
+    emit_end(options)
+  elif options['emit'] == 'json':
+    write_output(dump_json(data, indent=True) + '\n')
+  elif options['emit']:
+    emit_record(data, options)
+  else:
+    print(json.dumps(data, indent=4))
 
 def tag(
-  release,
+  release=None,
   dir='./',
   dry=False,
   skip=None,
   only=None,
-  dots_as_subtracks=True
+  dots_as_subtracks=True,
+  emit=None,
+  art=None,
+  art_size=None,
+  cache=None,
+  timings=False,
+  master=None
 ):
   """ Tag the audio files with the given Discogs release.
 
@@ -70,6 +275,12 @@ def tag(
       - The numeric portion of the above, e.g. 16215626
       - A local file URI pointing to a release JSON file
 
+  The MASTER flag replaces the RELEASE with the best matching version of a Discogs master release.
+  It can be a full Discogs master URL, its numeric portion, or a URI pointing to a master versions JSON file.
+
+      Each version is scored against the audio files on track count, disc structure and track durations.
+      Versions are fetched concurrently within the Discogs rate limit, and cached in the CACHE folder.
+
   The SKIP and ONLY flags can take one or more of the following values, comma-separated:
       artist, composer, title, position, date, subtracks, album, genre, albumartist
 
@@ -77,19 +288,95 @@ def tag(
 
   The flag DOTS_AS_SUBTRACKS considers track numbers such as "9.1", "9.2", etc to be subtracks.
 
+  The EMIT flag outputs one record per file in dry mode, and can take one of the following values:
+      json, jsonl, msgpack, table
+
+      The table format outputs one column per tag.
+
+  The ART flag writes the release cover art, and can take one of the following values:
+      embed   Embed the cover art in each audio file
+      folder  Write a single cover.jpg (or cover.png) file in each folder
+
+      The flag ART_SIZE resizes the cover art to fit within the given number of pixels (requires Pillow).
+
+  The flag CACHE sets the folder where downloaded images and master versions are cached, by default ~/.cache/discogs-tag.
+  Cached versions are fetched again after a week, in case they were edited on Discogs.
+
+  The flag TIMINGS prints the timings of each processing stage.
+
   """
   options = parse_options(locals())
-  response = get_release(release)
-  data = json.load(response)
-  files = list_files(dir)
-  apply_metadata(data, files, options)
+  options['stages'] = {}
+  started = time.perf_counter()
+  if release is None and master is None:
+    raise Exception('Expecting a RELEASE or a MASTER. Aborting.')
+
+  # The release is fetched while the files are listed and their first tags are read, then files are written one by one
+  # while the next ones are read ahead.
+  def fetch():
+    with stage(options, 'release'):
+      if master is not None:
+        return load_versions(master, options)
+      data = load_release(release, RELEASE_KEYS + ['images'] if options['art'] else RELEASE_KEYS)
+      if options['art'] and not options['dry']:
+        options['image'] = get_cover(data, options)
+      return data
+
+  def read(file):
+    with stage(options, 'read'):
+      return open_audio(file)
+
+  executor = ThreadPoolExecutor(max_workers=TAG_READERS)
+  try:
+    data = executor.submit(fetch)
+    with stage(options, 'scan'):
+      files = list_files(dir)
+    if master is not None:
+      # Only keep the audio lengths to pick the version, then read the files again to write them.
+      lengths = list(executor.map(lambda file: read(file).info.length, files))
+      with stage(options, 'pick'):
+        data = pick_version(data.result(), files, lengths, options)
+      if options['art'] and not options['dry']:
+        options['image'] = get_cover(data, options)
+      opener = read_ahead(executor, read, files, TAG_READERS * 2)
+    else:
+      opener = read_ahead(executor, read, files, TAG_READERS * 2)
+      data = data.result()
+    apply_metadata(data, files, options, opener)
+  finally:
+    executor.shutdown(wait=True, cancel_futures=True)
+  emit_end(options)
+  if options['timings']:
+    print_stages(options, started)
+
+def read_ahead(executor, read, files, window):
+  """ Return an opener that reads the given files in the background, at most WINDOW files ahead of the last opened one.
+
+  Each audio is dropped as soon as it is returned, so that memory stays bounded on large folders.
+  """
+  upcoming = deque(files)
+  futures = {}
+
+  def fill():
+    while upcoming and len(futures) < window:
+      file = upcoming.popleft()
+      futures[file] = executor.submit(read, file)
+
+  def opener(file):
+    future = futures.pop(file, None)
+    fill()
+    return future.result() if future else read(file)
+
+  fill()
+  return opener
 
 def copy(
   src,
   dir='./',
   dry=False,
   skip=None,
-  only=None
+  only=None,
+  emit=None
 ):
   """ Copy the audio tags from source to destination folders.
 
@@ -98,24 +385,31 @@ def copy(
 
       If subtracks are skipped, subtrack titles get appended to their parent track.
 
+  The EMIT flag outputs one record per destination file in dry mode, and can take one of the following values:
+      json, jsonl, msgpack, table
+
+      The table format outputs one column per tag.
+
   """
   options = parse_options(locals())
   src_files = list_files(src)
   if not src_files:
     raise Exception(f'No source files found at {src}. Aborting.')
 
-  audios = [mutagen.File(file, easy=True) for file in src_files]
+  audios = [open_audio(file) for file in src_files]
   data = read_metadata(audios, options)
   dst_files = list_files(dir)
-  if options['dry']:
+  if options['dry'] and not options['emit']:
     pprint(data, width=1000)
   else:
     apply_metadata(data, dst_files, options)
+  emit_end(options)
 
 def rename(
   format,
   dir='./',
   dry=False,
+  emit=None
 ):
   """ Rename the audio files based on the given format string.
 
@@ -132,6 +426,9 @@ def rename(
       /  Directory separator: Specifies subdirectories to be created starting from the given directory.
          Non-audio files will be moved to their existing subdirectories within the destination root which is assumed to be unique.
 
+  The EMIT flag outputs one record per operation in dry mode, and can take one of the following values:
+      json, jsonl, msgpack, table
+
   """
   options = parse_options(locals())
   src_root = os.path.realpath(dir)
@@ -141,8 +438,14 @@ def rename(
   if not files:
     raise Exception(f'Directory "{dir}" has no audio files. Aborting.')
 
+  # Keep track of the directories known to exist, and of the entries remaining in each source directory,
+  # to avoid redundant metadata syscalls on large trees.
+  options['src_parent'] = os.path.dirname(src_root)
+  options['dirs'] = set([options['src_parent']])
+  options['entries'] = {}
+
   # Extract and create destination root from first audio file.
-  audio = mutagen.File(files[0], easy=True)
+  audio = open_audio(files[0])
   _, dst_root = rename_path(src_root, audio, format, options)
 
   # Iterate on all files and directories to move them to the destination.
@@ -150,34 +453,896 @@ def rename(
   # - Other files are moved to the same subfolder in the destination tree
   # - Folders are recreated on the destination and removed from the source if empty
   for dirpath, dirnames, filenames in os.walk(src_root, topdown=False):
+    options['entries'][dirpath] = len(dirnames) + len(filenames)
+    options['dirs'].add(dirpath)
     for filename in filenames:
       src_filepath = os.path.join(dirpath, filename)
       _, ext = os.path.splitext(src_filepath)
       if ext[1:] in AUDIO_EXTENSIONS:
-        audio = mutagen.File(src_filepath, easy=True)
+        audio = open_audio(src_filepath)
         dst_path, _ = rename_path(src_root, audio, format, options)
         rename_file(src_filepath, dst_path, audio, format, options)
       else:
         dst_filepath = os.path.join(dst_root, os.path.relpath(src_filepath, src_root))
         if options['dry']:
-          print("%s => %s" % (src_filepath, dst_filepath))
+          emit_record({ 'op': 'move', 'src': src_filepath, 'dst': dst_filepath }, options, lambda: print("%s => %s" % (src_filepath, dst_filepath)))
         else:
-          os.makedirs(os.path.dirname(dst_filepath), exist_ok=True)
-          os.rename(src_filepath, dst_filepath)
+          make_dirs(os.path.dirname(dst_filepath), options)
+          move_file(src_filepath, dst_filepath, options)
     for dirname in dirnames:
-      src_path = os.path.join(dirpath, dirname)
-      if options['dry']:
-        print("✗ %s" % (src_path))
-      else:
-        with suppress(OSError):
-          os.rmdir(src_path)
+      remove_dir(os.path.join(dirpath, dirname), options)
 
   # Also delete source root.
+  remove_dir(src_root, options)
+  emit_end(options)
+
+def make_dirs(path, options):
+  """ Create a directory and its missing parents, once per run.
+
+  New directories are counted as entries of their parent, in case the parent is a source directory.
+  """
+  if path in options['dirs']:
+    return
+  parent = os.path.dirname(path)
+  if parent != path:
+    make_dirs(parent, options)
+  try:
+    os.mkdir(path)
+    if parent in options['entries']:
+      options['entries'][parent] += 1
+  except FileExistsError:
+    pass
+  options['dirs'].add(path)
+
+def move_file(src_file, dst_file, options):
+  """ Move a file, updating the count of entries remaining in the source directories. """
+  os.rename(src_file, dst_file)
+  entries = options.get('entries', {})
+  if os.path.dirname(src_file) in entries:
+    entries[os.path.dirname(src_file)] -= 1
+  if os.path.dirname(dst_file) in entries:
+    entries[os.path.dirname(dst_file)] += 1
+
+def remove_dir(path, options):
+  """ Remove a source directory if it is known to be empty. """
   if options['dry']:
-    print("✗ %s" % (src_root))
+    emit_record({ 'op': 'remove', 'src': path, 'dst': None }, options, lambda: print("✗ %s" % (path)))
+    return
+  if options['entries'].get(path) != 0:
+    return
+  with suppress(OSError):
+    os.rmdir(path)
+    options['dirs'].discard(path)
+    del options['entries'][path]
+    parent = os.path.dirname(path)
+    if parent in options['entries']:
+      options['entries'][parent] -= 1
+
+def watch(
+  root,
+  format=None,
+  dry=False,
+  skip=None,
+  only=None,
+  dots_as_subtracks=True,
+  settle=10,
+  interval=2,
+  queue_size=16,
+  state=None,
+  poll=False,
+  once=False
+):
+  """ Watch a directory for new album folders, then tag and rename them.
+
+  Each folder directly under ROOT is considered an album. Its RELEASE is read from a sidecar file
+  (release.txt, discogs.txt or .discogs) containing a Discogs release as accepted by the tag command,
+  or from the folder name ending with the release number in brackets, e.g. "Wish You Were Here [16215626]".
+  Folders without a release are ignored.
+
+  A folder is processed once its files have kept the same count, size and modification time for SETTLE seconds.
+  Processed folders are recorded in the STATE file, by default ROOT/.discogs-tag.json, so that restarts skip them.
+  Dry runs read the STATE file but never write it.
+
+  The FORMAT string, if given, is used to rename the folder after tagging, as per the rename command.
+  Rename destinations under ROOT are recorded as outputs, and are never processed as new albums.
+
+  The SKIP, ONLY and DOTS_AS_SUBTRACKS flags are passed to the tag command.
+
+  Changes are detected with inotify when the inotify_simple package is installed, or by polling every INTERVAL seconds otherwise.
+  When polling, a processed folder is looked at again once entries are added, removed or renamed anywhere inside it.
+  The flag POLL forces polling. The flag ONCE exits as soon as all current folders have been processed.
+
+  """
+  options = parse_options(locals())
+  root = os.path.realpath(root)
+  if not os.path.isdir(root):
+    raise Exception(f'Directory "{root}" not found. Aborting.')
+  state_path = state or os.path.join(root, WATCH_STATE)
+  state = load_watch_state(state_path)
+  lock = threading.Lock()
+  jobs = queue.Queue(maxsize=queue_size)
+  queued = set()
+  pending = {}
+
+  def record(folder, entry):
+    # Dry runs only keep their state in memory, so that a later run still processes the folders.
+    with lock:
+      state[folder] = dict(entry, mtime=folder_mtime(folder))
+      if not options['dry']:
+        save_watch_state(state_path, state)
+
+  def worker():
+    while True:
+      job = jobs.get()
+      if job is None:
+        return
+      folder, release = job
+      claimed = [folder]
+      def claim(path):
+        # Claim the rename destination before it appears, so that it is not picked up as a new folder.
+        with lock:
+          queued.add(path)
+        claimed.append(path)
+      try:
+        entry = process_watch_folder(folder, release, options, claim)
+        record(folder, entry)
+        for path in claimed[1:]:
+          record(path, dict(entry, result='output'))
+      except Exception as e:
+        print(f'Failed to record "{folder}": {e}', file=sys.stderr)
+      finally:
+        with lock:
+          queued.difference_update(claimed)
+        jobs.task_done()
+
+  def processed(folder, snapshot, release):
+    # Renaming keeps the files and their modification times, so a renamed folder has the same snapshot and release.
+    with lock:
+      if folder in state and state[folder]['snapshot'] == snapshot and state[folder]['release'] == release:
+        return state[folder]
+      return next((entry for entry in state.values() if entry['result'] == 'done' and entry['snapshot'] == snapshot and entry['release'] == release), None)
+
+  def scan(folders):
+    now = time.monotonic()
+    for folder in folders:
+      with lock:
+        entry = state.get(folder)
+        busy = folder in queued
+      if busy or folder in pending or not os.path.isdir(folder):
+        continue
+      # Ignore the folders written by the worker.
+      if entry and entry['result'] == 'output':
+        continue
+      # Without inotify, only look inside folders whose entries changed since they were processed.
+      if inotify is None and entry and entry['mtime'] == folder_mtime(folder):
+        continue
+      release = folder_release(folder)
+      if release is not None:
+        pending[folder] = { 'release': release, 'snapshot': None, 'since': now }
+
+    for folder in list(pending):
+      if not os.path.isdir(folder):
+        del pending[folder]
+        continue
+      snapshot = folder_snapshot(folder)
+      if snapshot != pending[folder]['snapshot']:
+        pending[folder].update({ 'snapshot': snapshot, 'since': now })
+      elif now - pending[folder]['since'] >= settle:
+        job = pending.pop(folder)
+        entry = processed(folder, snapshot, job['release'])
+        if entry:
+          record(folder, entry)
+        else:
+          with lock:
+            queued.add(folder)
+          jobs.put((folder, job['release']))
+
+  def idle():
+    # All current folders with a release have been processed.
+    if pending or jobs.unfinished_tasks:
+      return False
+    with lock:
+      return all(folder in state for folder in list_album_folders(root) if folder_release(folder) is not None)
+
+  inotify = None
+  watches = {}
+  if INotify and not poll:
+    inotify = INotify()
+    mask = inotify_flags.CREATE | inotify_flags.CLOSE_WRITE | inotify_flags.MODIFY | inotify_flags.ATTRIB | inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM | inotify_flags.DELETE
+    def add_watches(path):
+      for dirpath, _, _ in os.walk(path):
+        with suppress(OSError):
+          watches[inotify.add_watch(dirpath, mask)] = dirpath
+    add_watches(root)
+
+  thread = threading.Thread(target=worker, daemon=True)
+  thread.start()
+  try:
+    folders = list_album_folders(root)
+    while True:
+      scan(folders)
+      if once and idle():
+        break
+      if inotify is None:
+        time.sleep(interval)
+        folders = list_album_folders(root)
+      else:
+        folders = set()
+        for event in inotify.read(timeout=int(interval * 1000)):
+          path = os.path.join(watches.get(event.wd, root), event.name)
+          if event.mask & inotify_flags.ISDIR and event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+            add_watches(path)
+          relpath = os.path.relpath(path, root)
+          if relpath != '.' and not relpath.startswith('..'):
+            folders.add(os.path.join(root, relpath.split(os.sep)[0]))
+  finally:
+    jobs.put(None)
+    thread.join()
+    if inotify is not None:
+      inotify.close()
+
+def batch(
+  root,
+  src=None,
+  dry=False,
+  skip=None,
+  only=None,
+  dots_as_subtracks=True,
+  checkpoint=None,
+  shard=None,
+  dedupe=False,
+  index=None
+):
+  """ Tag all album folders under a directory, resuming from previous runs.
+
+  Each folder directly under ROOT is considered an album, whose release is found as per the watch command.
+  If SRC is given, tags are instead copied from the folder with the same name under SRC, as per the copy command.
+
+  Each processed folder is appended to the CHECKPOINT log, by default ROOT/.discogs-tag.log, with its release,
+  content hash and status. Folders that were completed and have not changed since are skipped.
+
+  The SHARD flag, given as i/N with 0 <= i < N, only processes the i-th of N deterministic shards of the folders,
+  so that several machines can split a library. Folders are also claimed with a file lock next to the checkpoint log,
+  so that two runs never process the same folder at the same time. Lock files are removed once their folder is processed,
+  and folders claimed by another run are reported as busy rather than skipped.
+
+  The flag DEDUPE skips folders whose audio is already known to be tagged with the same release,
+  according to the audio fingerprints of the INDEX database as per the dupes command.
+
+  The SKIP, ONLY and DOTS_AS_SUBTRACKS flags are passed to the tag or copy command.
+
+  """
+  options = parse_options(locals())
+  root = os.path.realpath(root)
+  if not os.path.isdir(root):
+    raise Exception(f'Directory "{root}" not found. Aborting.')
+  checkpoint = checkpoint or os.path.join(root, BATCH_CHECKPOINT)
+  shard_index, shard_count = parse_shard(shard)
+  entries = {}
+  offset = read_checkpoint(checkpoint, entries, 0)
+  results = { 'done': 0, 'failed': 0, 'skipped': 0, 'busy': 0 }
+  db = open_index(index) if dedupe else None
+
+  # A single process pool hashes the MP3 files of all folders.
+  with ProcessPoolExecutor() if dedupe else nullcontext() as pool:
+    for folder in list_album_folders(root):
+      name = os.path.relpath(folder, root)
+      if int(hashlib.sha1(name.encode('utf-8')).hexdigest(), 16) % shard_count != shard_index:
+        continue
+      release = os.path.join(src, name) if src else folder_release(folder)
+      if release is None or (src and not os.path.isdir(release)):
+        continue
+      with claim_folder(checkpoint, name) as claimed:
+        if not claimed:
+          results['busy'] += 1
+          continue
+        # Another run may have completed the folder before it was claimed.
+        offset = read_checkpoint(checkpoint, entries, offset)
+        if entries.get(name) == folder_hash(folder):
+          results['skipped'] += 1
+          continue
+        entry = { 'folder': name, 'release': str(release), 'status': 'done' }
+        if db:
+          files = list_files(folder)
+          fingerprints = index_files(db, files, pool=pool)
+          tagged = tagged_copy(db, fingerprints.values(), str(release), folder)
+          if tagged:
+            print(f'Skipping "{folder}": already tagged with release {release} in "{tagged}".', file=sys.stderr)
+            results['skipped'] += 1
+            if not options['dry']:
+              entry.update({ 'status': 'duplicate', 'duplicate': tagged, 'hash': folder_hash(folder), 'node': socket.gethostname(), 'time': time.time() })
+              append_checkpoint(checkpoint, entry)
+            continue
+        try:
+          if src:
+            copy(release, dir=folder, dry=options['dry'], skip=options['skip'], only=options['only'])
+          else:
+            tag(release, dir=folder, dry=options['dry'], skip=options['skip'], only=options['only'], dots_as_subtracks=options['dots_as_subtracks'])
+        except Exception as e:
+          print(f'Failed to process "{folder}": {e}', file=sys.stderr)
+          entry.update({ 'status': 'failed', 'error': str(e) })
+        results[entry['status']] += 1
+        if not options['dry']:
+          if db and entry['status'] == 'done':
+            index_release(db, files, fingerprints, str(release))
+          entry.update({ 'hash': folder_hash(folder), 'node': socket.gethostname(), 'time': time.time() })
+          append_checkpoint(checkpoint, entry)
+
+  print(f'Processed {results["done"]} folders, {results["failed"]} failed, {results["skipped"]} skipped, {results["busy"]} busy.')
+
+def dupes(
+  dir='./',
+  index=None,
+  workers=None,
+  emit=None
+):
+  """ Find duplicate audio files and albums using audio fingerprints.
+
+  FLAC files are identified by the audio MD5 of their STREAMINFO block, and MP3 files by a hash of their audio frames
+  excluding tags, so that identical audio is detected regardless of its tags. Other formats are ignored.
+
+  Fingerprints are stored in the INDEX database, by default ~/.cache/discogs-tag/index.sqlite, along with the size and
+  modification time of each file, so that unchanged files are never hashed again and duplicates are found across runs.
+  MP3 files are hashed by a pool of WORKERS processes, by default one per CPU.
+
+  The EMIT flag outputs one record per group of duplicates, and can take one of the following values:
+      json, jsonl, msgpack, table
+
+  """
+  options = parse_options(locals())
+  db = open_index(index)
+  files = list_files(os.path.realpath(dir))
+  fingerprints = index_files(db, files, workers)
+
+  # Duplicate files, including files indexed in earlier runs.
+  folders = set()
+  for fingerprint in sorted(set(fingerprints.values())):
+    paths = [path for path, in db.execute('SELECT path FROM files WHERE fingerprint = ? ORDER BY path', (fingerprint,)) if os.path.exists(path)]
+    if len(paths) > 1:
+      folders.update(os.path.dirname(path) for path in paths)
+      emit_record({ 'type': 'file', 'fingerprint': fingerprint, 'paths': paths }, options, lambda: print('\n  '.join(['= ' + paths[0]] + paths[1:])))
+
+  # Duplicate albums are folders with exactly the same audio, one of which was scanned.
+  scanned = set(os.path.dirname(file) for file in fingerprints)
+  albums = {}
+  for folder in sorted(folders):
+    rows = db.execute('SELECT path, fingerprint FROM files WHERE path > ? AND path < ? AND fingerprint IS NOT NULL', (folder + os.sep, folder + chr(ord(os.sep) + 1)))
+    album = frozenset(fingerprint for path, fingerprint in rows if os.path.dirname(path) == folder and os.path.exists(path))
+    albums.setdefault(album, []).append(folder)
+  for paths in albums.values():
+    if len(paths) > 1 and scanned.intersection(paths):
+      emit_record({ 'type': 'album', 'fingerprint': None, 'paths': paths }, options, lambda: print('\n  '.join(['= ' + paths[0] + os.sep] + [path + os.sep for path in paths[1:]])))
+  emit_end(options)
+
+def verify(
+  dir='./',
+  decode=False,
+  workers=None,
+  emit='jsonl'
+):
+  """ Verify the integrity of audio files and the consistency of their tags.
+
+  Each file is checked for structural integrity: FLAC metadata blocks, first and last frames, MP3 frames, and tags that can be read.
+  The flag DECODE also fully decodes FLAC files to compare their audio with the STREAMINFO MD5 (requires the flac program).
+  Files are checked by a pool of WORKERS processes, by default one per CPU.
+
+  Each folder of audio files is checked as an album: a single album, album artist and date,
+  contiguous track numbers on each disc, and contiguous disc numbers when present.
+
+  The EMIT flag outputs one record per file and per album, and can take one of the following values:
+      json, jsonl, msgpack, table
+
+  """
+  options = parse_options(locals())
+  root = os.path.realpath(dir)
+  if not os.path.isdir(root):
+    raise Exception(f'Directory "{dir}" not found. Aborting.')
+  if decode and not shutil.which('flac'):
+    raise Exception('Decoding requires the flac program. Aborting.')
+  results = { 'files': 0, 'albums': 0, 'errors': 0 }
+
+  def report(folder, futures):
+    files = [future.result() for future in futures]
+    for file in files:
+      emit_record({ 'type': 'file', 'path': file['path'], 'ok': not file['errors'], 'errors': file['errors'] }, options, lambda: print(f'{"✓" if not file["errors"] else "✗"} {file["path"]}'))
+    errors = verify_album([file['tags'] for file in files if file['tags'] is not None])
+    emit_record({ 'type': 'album', 'path': folder, 'ok': not errors, 'errors': errors }, options, lambda: print(f'{"✓" if not errors else "✗"} {folder}{os.sep}'))
+    results['files'] += len(files)
+    results['albums'] += 1
+    results['errors'] += sum(len(file['errors']) for file in files) + len(errors)
+
+  # Folders are walked lazily and only a bounded window of them is in flight, to keep memory constant.
+  pending = deque()
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    for dirpath, dirnames, filenames in os.walk(root):
+      dirnames.sort()
+      files = [os.path.join(dirpath, filename) for filename in sorted(filenames) if os.path.splitext(filename)[1][1:] in AUDIO_EXTENSIONS]
+      if files:
+        pending.append((dirpath, [executor.submit(verify_file, file, decode) for file in files]))
+      while len(pending) > VERIFY_WINDOW:
+        report(*pending.popleft())
+    while pending:
+      report(*pending.popleft())
+  emit_end(options)
+
+  print(f'Verified {results["files"]} files in {results["albums"]} albums, found {results["errors"]} errors.', file=sys.stderr)
+  if results['errors']:
+    raise Exception(f'Found {results["errors"]} errors. Aborting.')
+
+def verify_file(file, decode=False):
+  """ Check the structural integrity of an audio file and return its errors along with the tags needed by album checks. """
+  errors = []
+  ext = os.path.splitext(file)[1][1:].lower()
+  try:
+    if ext == 'flac':
+      errors += verify_flac(file)
+    elif ext == 'mp3':
+      errors += verify_mp3(file)
+  except Exception as e:
+    errors.append(f'Cannot read audio: {e}')
+
+  tags = None
+  try:
+    audio = open_audio(file)
+    tags = { key: audio.get(key, [''])[0] for key in ['album', 'albumartist', 'date', 'tracknumber', 'discnumber'] }
+  except Exception as e:
+    errors.append(f'Cannot read tags: {e}')
+
+  if decode and ext == 'flac' and not errors:
+    process = subprocess.run(['flac', '--test', '--silent', file], capture_output=True, text=True)
+    if process.returncode != 0:
+      errors.append(f'Decoding failed: {process.stderr.strip()}')
+  return { 'path': file, 'errors': errors, 'tags': tags }
+
+def verify_flac(file):
+  """ Check the FLAC signature, the chain of metadata blocks, the sync code of the first frame and the completeness of the last one. """
+  with open(file, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return ['Empty file']
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      start, end = id3_end(data), len(data)
+      if data[start:start + 4] != b'fLaC':
+        return ['Missing FLAC signature']
+      pos = start + 4
+      if data[pos] & 0x7f != 0 or int.from_bytes(data[pos + 1:pos + 4], 'big') != 34:
+        return ['Missing or invalid STREAMINFO block']
+      while True:
+        if pos + 4 > end:
+          return ['Truncated metadata block header']
+        header = data[pos]
+        length = int.from_bytes(data[pos + 1:pos + 4], 'big')
+        if header & 0x7f == 127:
+          return [f'Invalid metadata block type at offset {pos}']
+        pos += 4 + length
+        if pos > end:
+          return [f'Truncated metadata block at offset {pos - 4 - length}']
+        if header & 0x80:
+          break
+      if pos + 2 > end or data[pos] != 0xff or data[pos + 1] & 0xfe != 0xf8:
+        return [f'Missing frame sync at offset {pos}']
+
+      # The last frame is the last valid frame header whose CRC-16 matches the end of the audio, within the largest possible frame.
+      info = data[start + 8:start + 42]
+      block, size = int.from_bytes(info[2:4], 'big'), int.from_bytes(info[7:10], 'big')
+      channels, bits, total = ((info[12] >> 1) & 7) + 1, ((info[12] & 1) << 4 | info[13] >> 4) + 1, int.from_bytes(info[13:18], 'big') & 0xfffffffff
+      end = tags_start(data)
+      first = max(pos, end - (size or block * (channels * bits + 1) // 8 + FLAC_FRAME_OVERHEAD))
+      last = end
+      while True:
+        last = data.rfind(b'\xff', first, last)
+        if last == -1:
+          return ['Truncated last frame']
+        header = flac_frame_header(data, last, end)
+        if header and flac_crc(data[last:end - 2], 16) == int.from_bytes(data[end - 2:end], 'big'):
+          break
+      number, samples, variable = header
+      samples += number if variable else number * block
+      if total and samples != total:
+        return [f'Truncated audio: {samples} of {total} samples']
+  return []
+
+def flac_frame_header(data, pos, end):
+  """ Return the frame or sample number, block size and blocking strategy of the FLAC frame header at the given offset, or None if it is not valid. """
+  if pos + 6 > end or data[pos] != 0xff or data[pos + 1] & 0xfe != 0xf8:
+    return None
+  size, rate = data[pos + 2] >> 4, data[pos + 2] & 15
+  if size == 0 or rate == 15 or data[pos + 3] >> 4 > 10 or (data[pos + 3] >> 1) & 7 == 3 or data[pos + 3] & 1:
+    return None
+  # The frame or sample number is coded like UTF-8, on up to 7 bytes.
+  ones = 8 - (~data[pos + 4] & 0xff).bit_length()
+  if ones == 1 or ones == 8:
+    return None
+  number = data[pos + 4] & (0xff >> (ones + 1))
+  cursor = pos + 5
+  for _ in range(ones - 1):
+    if cursor >= end or data[cursor] & 0xc0 != 0x80:
+      return None
+    number = number << 6 | data[cursor] & 0x3f
+    cursor += 1
+  if size == 6:
+    samples = data[cursor] + 1
+    cursor += 1
+  elif size == 7:
+    samples = int.from_bytes(data[cursor:cursor + 2], 'big') + 1
+    cursor += 2
+  else:
+    samples = 192 if size == 1 else 576 << (size - 2) if size < 6 else 256 << (size - 8)
+  cursor += 1 if rate == 12 else 2 if rate in [13, 14] else 0
+  if cursor >= end or flac_crc(data[pos:cursor], 8) != data[cursor]:
+    return None
+  return number, samples, bool(data[pos + 1] & 1)
+
+def flac_crc_table(bits, poly):
+  """ Return the lookup table of the CRC of the given width and polynomial used by FLAC frames. """
+  table = []
+  for byte in range(256):
+    crc = byte << (bits - 8)
+    for _ in range(8):
+      crc = (crc << 1) ^ poly if crc & (1 << (bits - 1)) else crc << 1
+    table.append(crc & ((1 << bits) - 1))
+  return table
+
+FLAC_CRC_TABLES = { 8: flac_crc_table(8, 0x07), 16: flac_crc_table(16, 0x8005) }
+
+def flac_crc(data, bits):
+  """ Return the CRC-8 of a FLAC frame header or the CRC-16 of a FLAC frame. """
+  table, mask = FLAC_CRC_TABLES[bits], (1 << bits) - 1
+  crc = 0
+  for byte in data:
+    crc = table[(crc >> (bits - 8)) ^ byte] ^ ((crc << 8) & mask)
+  return crc
+
+def verify_mp3(file):
+  """ Walk the MPEG audio frames between the tags, checking that they are contiguous and complete. """
+  errors = []
+  with open(file, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return ['Empty file']
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      pos, end = id3_end(data), tags_start(data)
+      frames = 0
+      while pos + 4 <= end and len(errors) < VERIFY_MAX_ERRORS:
+        length = mp3_frame_length(data[pos:pos + 4])
+        if length is None:
+          # Resynchronize on the next valid frame header.
+          sync = data.find(b'\xff', pos + 1, end)
+          while sync != -1 and mp3_frame_length(data[sync:sync + 4]) is None:
+            sync = data.find(b'\xff', sync + 1, end)
+          if sync == -1:
+            errors.append(f'Junk data at offset {pos}')
+            break
+          errors.append(f'Lost frame sync at offset {pos}')
+          pos = sync
+          continue
+        if pos + length > end:
+          errors.append(f'Truncated frame at offset {pos}')
+          break
+        frames += 1
+        pos += length
+      if not frames:
+        errors.append('No audio frames')
+  return errors
+
+def mp3_frame_length(header):
+  """ Return the length of the MPEG audio frame starting with the given 4 bytes, or None if they are not a valid header. """
+  if len(header) < 4 or header[0] != 0xff or header[1] & 0xe0 != 0xe0:
+    return None
+  version = (header[1] >> 3) & 3
+  layer = 4 - ((header[1] >> 1) & 3)
+  bitrate = (header[2] >> 4) & 15
+  rate = (header[2] >> 2) & 3
+  padding = (header[2] >> 1) & 1
+  if version == 1 or layer == 4 or bitrate in [0, 15] or rate == 3:
+    return None
+  bitrate = MP3_BITRATES[(1 if version == 3 else 2, layer)][bitrate] * 1000
+  rate = MP3_SAMPLE_RATES[version][rate]
+  if layer == 1:
+    return (12 * bitrate // rate + padding) * 4
+  if layer == 3 and version != 3:
+    return 72 * bitrate // rate + padding
+  return 144 * bitrate // rate + padding
+
+def id3_end(data):
+  """ Return the offset following the ID3v2 tag at the start of the data, if any. """
+  if data[:3] != b'ID3':
+    return 0
+  size = (data[6] & 0x7f) << 21 | (data[7] & 0x7f) << 14 | (data[8] & 0x7f) << 7 | (data[9] & 0x7f)
+  return 10 + size + (10 if data[5] & 0x10 else 0)
+
+def tags_start(data):
+  """ Return the offset of the ID3v1 and APEv2 tags at the end of the data, if any. """
+  end = len(data)
+  if data[end - 128:end - 125] == b'TAG':
+    end -= 128
+  if end >= 32 and data[end - 32:end - 24] == b'APETAGEX':
+    flags = int.from_bytes(data[end - 12:end - 8], 'little')
+    end -= int.from_bytes(data[end - 20:end - 16], 'little') + (32 if flags & 0x80000000 else 0)
+  return end
+
+def verify_album(tags):
+  """ Check the consistency of the tags of the files of an album, as written by apply_metadata_track. """
+  errors = []
+  for key in ['album', 'albumartist', 'date']:
+    values = sorted(set(tag[key] for tag in tags))
+    if len(values) > 1:
+      errors.append(f'Inconsistent {key}: {NON_TITLE_SEPARATOR.join(values)}')
+
+  def number(value):
+    with suppress(ValueError):
+      return int(str(value).split('/')[0])
+    return None
+
+  discs = {}
+  for tag in tags:
+    discs.setdefault(number(tag['discnumber']) if tag['discnumber'] else None, []).append(number(tag['tracknumber']))
+  if None in discs and len(discs) > 1:
+    errors.append('Missing discnumber on some tracks')
+  numbered = sorted(disc for disc in discs if disc is not None)
+  if numbered and numbered != list(range(numbered[0], numbered[0] + len(numbered))):
+    errors.append(f'Non-contiguous discnumbers: {", ".join(str(disc) for disc in numbered)}')
+  for disc, tracks in discs.items():
+    if None in tracks:
+      # Non-numeric positions such as vinyl sides are not checked.
+      continue
+    if sorted(tracks) != list(range(1, len(tracks) + 1)):
+      errors.append(f'Non-contiguous tracknumbers{f" on disc {disc}" if disc is not None else ""}: {", ".join(str(track) for track in sorted(tracks))}')
+  return errors
+
+def open_index(path=None):
+  """ Open the audio fingerprint index database, creating it if needed. """
+  path = path or os.path.join(cache_dir(), INDEX_FILE)
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  db = sqlite3.connect(path)
+  db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, fingerprint TEXT, release TEXT)')
+  db.execute('CREATE INDEX IF NOT EXISTS files_fingerprint ON files (fingerprint)')
+  return db
+
+def index_files(db, files, workers=None, pool=None):
+  """ Return the fingerprints of the given audio files, hashing only the files that changed since they were indexed.
+
+  MP3 files are hashed in the given process POOL, or else in a pool of WORKERS processes started for the call.
+  """
+  fingerprints = {}
+  stale = []
+  for file in files:
+    file = os.path.realpath(file)
+    stat = os.stat(file)
+    row = db.execute('SELECT size, mtime, fingerprint FROM files WHERE path = ?', (file,)).fetchone()
+    if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+      fingerprints[file] = row[2]
+    else:
+      stale.append((file, stat))
+
+  # MP3 files are hashed in full in a process pool, FLAC fingerprints are read from the header and other files have none.
+  mp3s = [(file, stat) for file, stat in stale if file.lower().endswith('.mp3')]
+  hashed = [(file, stat, audio_fingerprint(file)) for file, stat in stale if not file.lower().endswith('.mp3')]
+  if len(mp3s) > 1:
+    with nullcontext(pool) if pool else ProcessPoolExecutor(max_workers=workers) as executor:
+      results = executor.map(audio_fingerprint, [file for file, _ in mp3s], chunksize=INDEX_CHUNK_SIZE)
+      hashed += [(file, stat, fingerprint) for (file, stat), fingerprint in zip(mp3s, results)]
   else:
+    hashed += [(file, stat, audio_fingerprint(file)) for file, stat in mp3s]
+
+  # Tagging refreshes the size and modification time of indexed files, so a stale row means the file was edited since.
+  with db:
+    for file, stat, fingerprint in hashed:
+      db.execute('INSERT INTO files (path, size, mtime, fingerprint) VALUES (?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime, release = NULL, fingerprint = excluded.fingerprint', (file, stat.st_size, stat.st_mtime_ns, fingerprint))
+      fingerprints[file] = fingerprint
+  return { file: fingerprint for file, fingerprint in fingerprints.items() if fingerprint }
+
+def index_release(db, files, fingerprints, release):
+  """ Record that the given audio files were tagged with the release, keeping their fingerprints which tagging does not change. """
+  with db:
+    for file in files:
+      file = os.path.realpath(file)
+      if file in fingerprints:
+        stat = os.stat(file)
+        db.execute('UPDATE files SET size = ?, mtime = ?, release = ? WHERE path = ?', (stat.st_size, stat.st_mtime_ns, release, file))
+
+def tagged_copy(db, fingerprints, release, folder):
+  """ Return the folder of an existing copy of the given audio, other than FOLDER, that is tagged with the release, if all files have one. """
+  fingerprints = list(fingerprints)
+  folder = os.path.realpath(folder)
+  folders = None
+  for fingerprint in fingerprints:
+    rows = db.execute('SELECT path, size, mtime FROM files WHERE fingerprint = ? AND release = ?', (fingerprint, release)).fetchall()
+    found = set(os.path.dirname(path) for path, size, mtime in rows if unchanged(path, size, mtime)) - {folder}
+    folders = found if folders is None else folders & found
+    if not folders:
+      return None
+  return sorted(folders)[0] if folders else None
+
+def unchanged(path, size, mtime):
+  """ Check whether an indexed file still exists with the given size and modification time, i.e. was not edited since. """
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return False
+  return stat.st_size == size and stat.st_mtime_ns == mtime
+
+def audio_fingerprint(file):
+  """ Return a fingerprint of the audio data of a FLAC or MP3 file, independent of its tags, or None for other files. """
+  ext = os.path.splitext(file)[1][1:].lower()
+  if ext not in ['flac', 'mp3']:
+    return None
+  with open(file, 'rb') as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return None
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      start, end = id3_end(data), len(data)
+      if ext == 'flac':
+        if data[start:start + 4] != b'fLaC':
+          return None
+        # STREAMINFO is always the first metadata block, and holds the MD5 of the decoded audio at offset 18.
+        md5 = data[start + 8 + 18:start + 8 + 34]
+        if any(md5):
+          return 'flac:' + md5.hex()
+        # Without an MD5, hash the audio frames that follow the metadata blocks.
+        start += 4
+        while start + 4 <= end:
+          header = data[start]
+          start += 4 + int.from_bytes(data[start + 1:start + 4], 'big')
+          if header & 0x80:
+            break
+      else:
+        end = tags_start(data)
+      with memoryview(data) as view:
+        return f'{ext}-frames:' + hashlib.sha1(view[start:max(start, end)]).hexdigest()
+
+def parse_shard(shard):
+  """ Parse a shard specification i/N into (i, N). """
+  if shard is None:
+    return 0, 1
+  try:
+    index, count = [int(n) for n in str(shard).split('/')]
+  except ValueError:
+    index, count = -1, 0
+  if not 0 <= index < count:
+    raise Exception(f'Invalid shard "{shard}". Expecting i/N with 0 <= i < N.')
+  return index, count
+
+def folder_hash(folder):
+  """ Hash the relative paths, sizes and modification times of the files of a folder. """
+  digest = hashlib.sha256()
+  for dirpath, dirnames, filenames in os.walk(folder):
+    dirnames.sort()
+    for filename in sorted(filenames):
+      path = os.path.join(dirpath, filename)
+      with suppress(OSError):
+        stat = os.stat(path)
+        digest.update(f'{os.path.relpath(path, folder)}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode('utf-8'))
+  return digest.hexdigest()
+
+def read_checkpoint(path, entries, offset):
+  """ Read the checkpoint log from the given offset, recording the hash of completed folders, and return the new offset. """
+  with suppress(FileNotFoundError):
+    with open(path, 'rb') as f:
+      f.seek(offset)
+      for line in f:
+        if not line.endswith(b'\n'):
+          # Partial line being appended by another run.
+          break
+        offset += len(line)
+        with suppress(ValueError):
+          entry = json.loads(line)
+          if entry['status'] in ['done', 'duplicate']:
+            entries[entry['folder']] = entry['hash']
+          else:
+            entries.pop(entry['folder'], None)
+  return offset
+
+def append_checkpoint(path, entry):
+  """ Append an entry to the checkpoint log, locking it against concurrent runs. """
+  with open(path, 'ab') as f:
+    if fcntl:
+      fcntl.flock(f, fcntl.LOCK_EX)
+    f.write(dump_json(entry).encode('utf-8') + b'\n')
+    f.flush()
+    os.fsync(f.fileno())
+
+@contextmanager
+def claim_folder(checkpoint, name):
+  """ Claim a folder with an exclusive file lock, which is released when the run ends or dies.
+
+  The lock file is removed before the lock is released, so lock files do not pile up with the library size.
+  A lock taken on a file that was meanwhile removed by its previous holder is retried on the new file.
+  """
+  if fcntl is None:
+    yield True
+    return
+  locks = f'{checkpoint}.locks'
+  os.makedirs(locks, exist_ok=True)
+  path = os.path.join(locks, hashlib.sha1(name.encode('utf-8')).hexdigest())
+  while True:
+    with open(path, 'a') as f:
+      try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except OSError:
+        yield False
+        return
+      try:
+        stale = os.fstat(f.fileno()).st_ino != os.stat(path).st_ino
+      except FileNotFoundError:
+        stale = True
+      if stale:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        continue
+      try:
+        yield True
+      finally:
+        with suppress(OSError):
+          os.remove(path)
+        fcntl.flock(f, fcntl.LOCK_UN)
+      return
+
+def list_album_folders(root):
+  """ List the album folders directly under the given root. """
+  with os.scandir(root) as entries:
+    return sorted(entry.path for entry in entries if entry.is_dir() and not entry.name.startswith('.'))
+
+def folder_release(folder):
+  """ Get the release of an album folder from its sidecar file or its name. """
+  for sidecar in WATCH_SIDECARS:
+    with suppress(OSError):
+      with open(os.path.join(folder, sidecar)) as f:
+        release = f.read().strip()
+      if release:
+        return release
+  match = re.search(WATCH_FOLDER_RELEASE, os.path.basename(folder))
+  return match.group(1) if match else None
+
+def folder_snapshot(folder):
+  """ Summarize the files of a folder as [count, total size, latest modification time]. """
+  count, size, mtime = 0, 0, 0
+  for dirpath, _, filenames in os.walk(folder):
+    for filename in filenames:
+      with suppress(OSError):
+        stat = os.stat(os.path.join(dirpath, filename))
+        count += 1
+        size += stat.st_size
+        mtime = max(mtime, stat.st_mtime)
+  return [count, size, mtime]
+
+def folder_mtime(folder):
+  """ Get the latest modification time of a folder and its subfolders, which changes whenever an entry is added, removed or renamed. """
+  mtime = None
+  for dirpath, _, _ in os.walk(folder):
     with suppress(OSError):
-      os.rmdir(src_root)
+      mtime = max(mtime or 0, os.stat(dirpath).st_mtime)
+  return mtime
+
+def process_watch_folder(folder, release, options, claim):
+  """ Tag then rename an album folder, returning its state entry.
+
+  The CLAIM function is called with the rename destination before the folder is renamed.
+  """
+  entry = { 'release': release, 'result': 'done', 'snapshot': None }
+  try:
+    tag(release, dir=folder, dry=options['dry'], skip=options['skip'], only=options['only'], dots_as_subtracks=options['dots_as_subtracks'])
+    entry['snapshot'] = folder_snapshot(folder)
+    if options['format']:
+      _, dst_root = rename_path(folder, open_audio(list_files(folder)[0]), options['format'], parse_options({ 'dry': True }))
+      if dst_root != folder:
+        claim(dst_root)
+      rename(options['format'], dir=folder, dry=options['dry'])
+  except Exception as e:
+    print(f'Failed to process "{folder}": {e}', file=sys.stderr)
+    entry.update({ 'result': 'failed', 'error': str(e) })
+    if os.path.isdir(folder):
+      entry['snapshot'] = folder_snapshot(folder)
+  return entry
+
+def load_watch_state(path):
+  with suppress(OSError):
+    with open(path) as f:
+      return json.load(f)
+  return {}
+
+def save_watch_state(path, state):
+  tmp = f'{path}.{os.getpid()}.tmp'
+  with open(tmp, 'w') as f:
+    json.dump(state, f, indent=2)
+  os.replace(tmp, path)
 
 def get_release(release):
   """ Get release JSON from Discogs URL, file URI or Discogs release number. """
@@ -186,13 +1351,196 @@ def get_release(release):
   }
   match = re.match(r"https://www\.discogs\.com/release/(\d*)", str(release))
   if match:
-    release = f'https://api.discogs.com/releases/{match.group(1)}'
+    release = match.group(1)
+  # Only bare release numbers go to the API, so that errors on full URLs are not retried against it.
+  if not urlparse(str(release)).scheme:
+    release = f'https://api.discogs.com/releases/{release}'
+  request = urllib.request.Request(release, headers=headers)
+  return urllib.request.urlopen(request)
+
+def load_release(release, keys=RELEASE_KEYS):
+  """ Get release from Discogs URL, file URI or Discogs release number, keeping only the given keys. """
+  return parse_release(get_release(release), keys)
+
+def get_master(master):
+  """ Get the first page of master versions JSON from Discogs URL, file URI or Discogs master number. """
+  headers = {
+    'User-Agent': f'{__NAME__} {__VERSION__}'
+  }
+  match = re.match(r"https://www\.discogs\.com/master/(\d*)", str(master))
+  if match:
+    master = match.group(1)
+  # Only bare master numbers go to the API, so that errors on full URLs are not retried against it.
+  if not urlparse(str(master)).scheme:
+    master = f'https://api.discogs.com/masters/{master}/versions?per_page=100'
+  request = urllib.request.Request(master, headers=headers)
+  return urllib.request.urlopen(request)
+
+def load_versions(master, options):
+  """ Get all the releases of a Discogs master.
+
+  The version list is paged through once, then the versions are fetched concurrently and cached.
+  """
+  options['requests'] = deque()
+  options['requests_lock'] = threading.Lock()
+  throttle(options)
+  page = json.load(get_master(master))
+  versions = page.get('versions', [])
+  while page.get('pagination', {}).get('urls', {}).get('next'):
+    throttle(options)
+    page = json.load(get_release(page['pagination']['urls']['next']))
+    versions += page.get('versions', [])
+  if not versions:
+    raise Exception(f'No versions found for master "{master}". Aborting.')
+
+  def fetch(version):
+    try:
+      data = cache_release(version.get('resource_url') or str(version['id']), options)
+      data['id'] = version.get('id')
+      return data
+    except Exception as e:
+      print(f'Could not fetch version {version.get("id")}: {e}. Ignoring.', file=sys.stderr)
+      return None
+
+  with ThreadPoolExecutor(max_workers=MASTER_WORKERS) as executor:
+    versions = [data for data in executor.map(fetch, versions) if data is not None]
+  if not versions:
+    raise Exception(f'No versions could be fetched for master "{master}". Aborting.')
+  return versions
+
+def throttle(options):
+  """ Wait until another Discogs request fits within the rate limit. """
+  with options['requests_lock']:
+    requests = options['requests']
+    now = time.monotonic()
+    while requests and now - requests[0] >= DISCOGS_RATE_WINDOW:
+      requests.popleft()
+    if len(requests) >= DISCOGS_RATE_LIMIT:
+      time.sleep(DISCOGS_RATE_WINDOW - (now - requests.popleft()))
+    requests.append(time.monotonic())
+
+def cache_release(release, options):
+  """ Get a release from the cache folder unless it expired, or download it and store its release keys and images there. """
+  cache = options['cache'] or cache_dir()
+  path = os.path.join(cache, 'releases', hashlib.sha256(release.encode('utf-8')).hexdigest() + '.json')
+  with suppress(OSError, ValueError):
+    if time.time() - os.stat(path).st_mtime < RELEASE_CACHE_TTL:
+      with open(path) as f:
+        return json.load(f)
+  throttle(options)
+  data = load_release(release, RELEASE_KEYS + ['images'])
+  write_atomic(path, json.dumps(data).encode('utf-8'))
+  return data
+
+def pick_version(versions, files, lengths, options):
+  """ Return the release version that best matches the audio files.
+
+  Versions are ranked on their track count difference, then on whether their discs match the folder structure,
+  then on the mean difference of their track durations with the audio LENGTHS.
+  """
+  folders = [len(list(group)) for _, group in groupby(files, os.path.dirname)]
+
+  def score(version):
+    try:
+      tracks = get_tracks(deepcopy(version.get('tracklist', [])), options)
+    except Exception:
+      return (float('inf'),)
+    discs = [len(list(group)) for _, group in groupby(tracks, lambda track: track['position'].split('-')[0] if '-' in track['position'] else '')]
+    durations = [
+      abs(parse_duration(track.get('duration')) - length)
+      for track, length in zip(tracks, lengths)
+      if parse_duration(track.get('duration')) is not None
+    ]
+    return (
+      abs(len(tracks) - len(files)),
+      len(folders) > 1 and discs != folders,
+      sum(durations) / len(durations) if durations else float('inf')
+    )
+
+  best = min(versions, key=score)
+  print(f'Using release {best.get("id")} out of {len(versions)} versions.', file=sys.stderr)
+  return best
+
+def parse_duration(duration):
+  """ Parse a Discogs track duration such as 4:05 or 1:02:03 into seconds. """
   try:
-    request = urllib.request.Request(release, headers=headers)
-    return urllib.request.urlopen(request)
+    return reduce(lambda total, part: total * 60 + int(part), duration.split(':'), 0)
   except Exception:
-    request = urllib.request.Request(f'https://api.discogs.com/releases/{release}', headers=headers)
-    return urllib.request.urlopen(request)
+    return None
+
+def parse_release(stream, keys=RELEASE_KEYS, chunk_size=RELEASE_CHUNK_SIZE):
+  """ Incrementally parse a release JSON stream, keeping only the given top-level keys.
+
+  The stream is decoded chunk by chunk and each top-level value is decoded on its own,
+  so that unused fields are discarded as soon as they are parsed and the full response
+  body is never held in memory alongside the parsed release.
+  """
+  decoder = json.JSONDecoder()
+  utf8 = codecs.getincrementaldecoder('utf-8')()
+  state = { 'buffer': '', 'pos': 0, 'eof': False }
+
+  def fill(size):
+    # Drop the consumed prefix and read at least `size` more characters from the stream.
+    state['buffer'] = state['buffer'][state['pos']:]
+    state['pos'] = 0
+    wanted = len(state['buffer']) + size
+    while not state['eof'] and len(state['buffer']) < wanted:
+      chunk = stream.read(size)
+      if not chunk:
+        state['eof'] = True
+        state['buffer'] += utf8.decode(b'', final=True)
+      else:
+        state['buffer'] += utf8.decode(chunk) if isinstance(chunk, bytes) else chunk
+
+  def peek():
+    # Skip whitespace and return the next significant character, or None at end of stream.
+    while True:
+      buffer = state['buffer']
+      while state['pos'] < len(buffer) and buffer[state['pos']] in ' \t\r\n':
+        state['pos'] += 1
+      if state['pos'] < len(buffer):
+        return buffer[state['pos']]
+      if state['eof']:
+        return None
+      fill(chunk_size)
+
+  def expect(chars):
+    char = peek()
+    if char is None or char not in chars:
+      raise Exception(f'Invalid release JSON: expecting one of "{chars}" but found "{char}".')
+    state['pos'] += 1
+    return char
+
+  def value():
+    # Decode the next complete value, growing the buffer geometrically until it fits.
+    peek()
+    size = chunk_size
+    while True:
+      try:
+        result, end = decoder.raw_decode(state['buffer'], state['pos'])
+        # A value that ends the buffer might be truncated, e.g. a number split across chunks.
+        if end < len(state['buffer']) or state['eof']:
+          state['pos'] = end
+          return result
+      except json.JSONDecodeError:
+        if state['eof']:
+          raise
+      fill(size)
+      size = max(size, len(state['buffer']))
+
+  data = {}
+  expect('{')
+  if peek() == '}':
+    return data
+  while True:
+    key = value()
+    expect(':')
+    item = value()
+    if key in keys:
+      data[key] = item
+    del item
+    if expect(',}') == '}':
+      return data
 
 def read_metadata(audios, options):
   """ Read metadata from audio files and return data structure that mimics Discogs release. """
@@ -233,59 +1581,63 @@ def read_metadata(audios, options):
     'tracklist': sorted(tracklist, key=lambda track: int(track['position'].split('-')[0]))
   }
 
-def apply_metadata(release, files, options):
-  """ Apply Discogs release metadada to audio files. """
-  def get_tracks(tracklist):
-    """ Deduce the actual file tracks from the Discogs metadata.
-
-    This can get tricky because many combinations of tracks + subtracks exist in the database.
-    """
-    def reduce_track(tracks, track_with_index):
-      index, track = track_with_index
-      if track['type_'] == 'track':
-        if options['dots_as_subtracks'] and '.' in track['position']:
-          num = int(track['position'].split('.')[0])
-          sub = int(track['position'].split('.')[1])
-          if sub == 1:
-            # Create a dummy track and add all subtracks to it.
-            # Reset the track number of the subtracks to renumber them in the output.
-            trk = track.copy()
-            trk['type_'] = 'track'
-            trk['position'] = str(num)
-            trk['title'] = ''
-            trk['sub_tracks'] = [t.copy() for t in tracklist[index:] if t['position'].split('.')[0] == str(num)]
-            for t in trk['sub_tracks']:
-              t['position'] = ''
-            if options['skip_subtracks']:
-              tracks.append(trk)
-            else:
-              tracks = tracks + get_tracks(trk['sub_tracks'])
-        else:
-          tracks.append(track)
-      elif 'sub_tracks' in track:
-        # Special case: These subtracks might belong to the previous track if the numbering matches.
-        skip_regular_case = False
-        if options['dots_as_subtracks'] and 'position' in track['sub_tracks'][0] and '.' in track['sub_tracks'][0]['position']:
-          num = int(track['sub_tracks'][0]['position'].split('.')[0])
-          sub = int(track['sub_tracks'][0]['position'].split('.')[1])
-          if sub > 1 and len(tracks):
-            skip_regular_case = True
-            for t in track['sub_tracks']:
-              t['position'] = ''
-            if options['skip_subtracks']:
-              tracks[-1]['sub_tracks'] += track['sub_tracks']
-            else:
-              tracks = tracks + get_tracks(track['sub_tracks'])
-
-        if not skip_regular_case:
+def get_tracks(tracklist, options):
+  """ Deduce the actual file tracks from the Discogs metadata.
+
+  This can get tricky because many combinations of tracks + subtracks exist in the database.
+  """
+  def reduce_track(tracks, track_with_index):
+    index, track = track_with_index
+    if track['type_'] == 'track':
+      if options['dots_as_subtracks'] and '.' in track['position']:
+        num = int(track['position'].split('.')[0])
+        sub = int(track['position'].split('.')[1])
+        if sub == 1:
+          # Create a dummy track and add all subtracks to it.
+          # Reset the track number of the subtracks to renumber them in the output.
+          trk = track.copy()
+          trk['type_'] = 'track'
+          trk['position'] = str(num)
+          trk['title'] = ''
+          trk['sub_tracks'] = [t.copy() for t in tracklist[index:] if t['position'].split('.')[0] == str(num)]
+          for t in trk['sub_tracks']:
+            t['position'] = ''
           if options['skip_subtracks']:
-            tracks.append(track)
+            tracks.append(trk)
           else:
-            tracks = tracks + get_tracks(track['sub_tracks'])
-      return tracks
-    return reduce(reduce_track, enumerate(tracklist), [])
+            tracks = tracks + get_tracks(trk['sub_tracks'], options)
+      else:
+        tracks.append(track)
+    elif 'sub_tracks' in track:
+      # Special case: These subtracks might belong to the previous track if the numbering matches.
+      skip_regular_case = False
+      if options['dots_as_subtracks'] and 'position' in track['sub_tracks'][0] and '.' in track['sub_tracks'][0]['position']:
+        num = int(track['sub_tracks'][0]['position'].split('.')[0])
+        sub = int(track['sub_tracks'][0]['position'].split('.')[1])
+        if sub > 1 and len(tracks):
+          skip_regular_case = True
+          for t in track['sub_tracks']:
+            t['position'] = ''
+          if options['skip_subtracks']:
+            tracks[-1]['sub_tracks'] += track['sub_tracks']
+          else:
+            tracks = tracks + get_tracks(track['sub_tracks'], options)
+
+      if not skip_regular_case:
+        if options['skip_subtracks']:
+          tracks.append(track)
+        else:
+          tracks = tracks + get_tracks(track['sub_tracks'], options)
+    return tracks
+  return reduce(reduce_track, enumerate(tracklist), [])
+
+def apply_metadata(release, files, options, opener=None):
+  """ Apply Discogs release metadada to audio files.
 
-  tracks = get_tracks(release['tracklist'])
+  The OPENER function returns the audio of a file, by default by opening it.
+  """
+  with stage(options, 'map'):
+    tracks = get_tracks(release['tracklist'], options)
   if len(files) != len(tracks):
     if options['dry']:
       print(f'Expecting {len(tracks)} files but found {len(files)}. Ignoring.', file=sys.stderr)
@@ -294,20 +1646,33 @@ def apply_metadata(release, files, options):
 
   for n, track in enumerate(tracks):
     try:
-      audio = mutagen.File(files[n], easy=True)
-      audio = apply_metadata_track(release, track, audio, n+1, options)
-      if options['dry']:
-        pprint(audio, width=1000)
-      else:
-        audio.save()
+      audio = (opener or open_audio)(files[n])
+      with stage(options, 'write'):
+        audio = apply_metadata_track(release, track, audio, n+1, options)
+        if options['art'] == 'embed' and options['image']:
+          embed_image(audio, options['image'])
+        if options['dry']:
+          if options['emit'] == 'table':
+            # One column per tag, so that the table can be processed by column.
+            record = { 'file': files[n], **{ key: audio.get(key) for key in TAG_KEYS } }
+          else:
+            record = { 'file': files[n], 'tags': dict(audio) }
+          emit_record(record, options, lambda: pprint(audio, width=1000))
+        else:
+          save_audio(audio)
     except Exception as e:
       if options['dry']:
         print(e, file=sys.stderr)
       else:
         raise e
 
+  if options['art'] == 'folder' and options['image'] and not options['dry']:
+    for dir in sorted(set(os.path.dirname(file) for file in files)):
+      write_folder_image(dir, options['image'])
+
   if not options['dry']:
-    print(f'Processed {len(files)} audio files.')
+    # Keep the standard output parseable when an output format is requested.
+    print(f'Processed {len(files)} audio files.', file=sys.stderr if options['emit'] else sys.stdout)
 
 def rename_component(audio, format, options):
   """ Rename a path component based on format string with tags from the audio metadata. """
@@ -359,11 +1724,15 @@ def rename_path(src_root, audio, format, options):
     return src_root, src_root
 
   # Create the new path.
-  dst_path = os.path.join(os.path.dirname(os.path.realpath(src_root)), *paths)
+  parent = options.get('src_parent') or os.path.dirname(os.path.realpath(src_root))
+  dst_path = os.path.join(parent, *paths)
   if not options['dry']:
-    os.makedirs(dst_path, exist_ok=True)
+    if 'dirs' in options:
+      make_dirs(dst_path, options)
+    else:
+      os.makedirs(dst_path, exist_ok=True)
 
-  return dst_path, os.path.join(os.path.dirname(os.path.realpath(src_root)), paths[0])
+  return dst_path, os.path.join(parent, paths[0])
 
 def rename_file(src_file, dst_path, audio, format, options):
   """ Rename audio file based on format string with tags from the audio metadata. """
@@ -387,16 +1756,228 @@ def rename_file(src_file, dst_path, audio, format, options):
   # Add the original path.
   dst_file = os.path.join(dst_path, filename)
   if options['dry']:
-    print("%s => %s" % (src_file, dst_file))
+    emit_record({ 'op': 'move', 'src': src_file, 'dst': dst_file }, options, lambda: print("%s => %s" % (src_file, dst_file)))
   else:
-    os.rename(src_file, dst_file)
+    move_file(src_file, dst_file, options)
 
   return dst_file
 
+class AudioTags(MutableMapping):
+  """ Dict-like view of the native tags of an audio file, using the same tag model as mutagen's easy interfaces.
+
+  Subclasses map the internal tag keys onto the native fields of containers that lack an easy interface.
+  """
+  def __init__(self, audio):
+    self.audio = audio
+    if audio.tags is None:
+      audio.add_tags()
+
+  @property
+  def info(self):
+    return self.audio.info
+
+  @property
+  def filename(self):
+    return self.audio.filename
+
+  def save(self, **kwargs):
+    self.audio.save(**kwargs)
+
+  def __iter__(self):
+    return iter([key for key in TAG_KEYS if self.get_native(key)])
+
+  def __len__(self):
+    return len(list(iter(self)))
+
+  def __getitem__(self, key):
+    values = self.get_native(key)
+    if not values:
+      raise KeyError(key)
+    return values
+
+  def __setitem__(self, key, value):
+    if key not in TAG_KEYS:
+      raise KeyError(key)
+    self.set_native(key, [value] if isinstance(value, str) else list(value))
+
+  def __delitem__(self, key):
+    if not self.get_native(key):
+      raise KeyError(key)
+    self.delete_native(key)
+
+  def __repr__(self):
+    return repr(dict(self))
+
+class ID3Tags(AudioTags):
+  """ Tags of ID3 containers such as AIFF, mapped through the EasyID3 key registry. """
+  def get_native(self, key):
+    try:
+      return EasyID3.Get[key](self.audio.tags, key) if key in TAG_KEYS else []
+    except KeyError:
+      return []
+
+  def set_native(self, key, values):
+    EasyID3.Set[key](self.audio.tags, key, values)
+
+  def delete_native(self, key):
+    EasyID3.Delete[key](self.audio.tags, key)
+
+  def set_picture(self, image):
+    id3_picture_set(self.audio.tags, 'picture', [image])
+
+class APEv2Tags(AudioTags):
+  """ Tags of APEv2 containers such as WavPack. """
+  def get_native(self, key):
+    if key in APEV2_KEYS and APEV2_KEYS[key] in self.audio.tags:
+      return list(self.audio.tags[APEV2_KEYS[key]])
+    return []
+
+  def set_native(self, key, values):
+    self.audio.tags[APEV2_KEYS[key]] = values
+
+  def delete_native(self, key):
+    del self.audio.tags[APEV2_KEYS[key]]
+
+  def set_picture(self, image):
+    data, mime = image
+    self.audio.tags['Cover Art (Front)'] = mutagen.apev2.APEValue(f'cover.{ART_TYPES[mime]}'.encode('utf-8') + b'\x00' + data, mutagen.apev2.BINARY)
+
+def open_audio(file):
+  """ Open audio file and return a dict-like view of its tags in the internal tag model. """
+  audio = mutagen.File(file, easy=True)
+  if audio is None:
+    raise Exception(f'Unsupported audio file "{file}".')
+  if isinstance(audio, mutagen.aiff.AIFF):
+    return ID3Tags(audio)
+  if isinstance(audio, mutagen.apev2.APEv2File):
+    return APEv2Tags(audio)
+  return audio
+
+def save_audio(audio):
+  """ Save audio file tags using the cheapest write path of its container.
+
+  FLAC, ID3, MP4 and Ogg tags are rewritten in place whenever the existing padding can absorb them,
+  instead of letting mutagen resize the padding which rewrites the whole file.
+  APEv2 tags are appended at the end of the file and never require a full rewrite.
+  """
+  def keep_padding(info):
+    return info.padding if info.padding >= 0 else info.get_default_padding()
+
+  if isinstance(audio, APEv2Tags):
+    audio.save()
+  else:
+    audio.save(padding=keep_padding)
+
+def cache_dir():
+  """ Return the default cache folder. """
+  return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))), __NAME__)
+
+def get_cover(release, options):
+  """ Get the release cover art as (data, mime), preferring the primary image. """
+  images = [image for image in release.get('images', []) if image.get('uri')]
+  if not images:
+    print('No cover art found for release. Ignoring.', file=sys.stderr)
+    return None
+  image = next((image for image in images if image.get('type') == 'primary'), images[0])
+  return cache_image(image['uri'], options)
+
+def cache_image(uri, options):
+  """ Download an image into the content-addressed cache and return it as (data, mime).
+
+  Images are stored under objects/ by the SHA-256 of their content, so that identical images are stored once.
+  Small files under refs/ map each image URI and size cap to its content hash, so that re-runs skip the download.
+  """
+  cache = options['cache'] or cache_dir()
+  ref = os.path.join(cache, 'refs', hashlib.sha256(f'{uri}#{options["art_size"] or ""}'.encode('utf-8')).hexdigest())
+
+  def object_path(digest):
+    return os.path.join(cache, 'objects', digest[:2], digest)
+
+  with suppress(OSError):
+    with open(ref) as f:
+      digest = f.read().strip()
+    with open(object_path(digest), 'rb') as f:
+      data = f.read()
+    return data, image_mime(data)
+
+  request = urllib.request.Request(uri, headers={
+    'User-Agent': f'{__NAME__} {__VERSION__}'
+  })
+  with urllib.request.urlopen(request) as response:
+    data = response.read()
+  if options['art_size']:
+    data = resize_image(data, int(options['art_size']))
+  mime = image_mime(data)
+  digest = hashlib.sha256(data).hexdigest()
+  if not os.path.exists(object_path(digest)):
+    write_atomic(object_path(digest), data)
+  write_atomic(ref, digest.encode('utf-8'))
+  return data, mime
+
+def write_atomic(path, data):
+  """ Write a file through a temporary file, so that concurrent readers never see it partially written. """
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+  with open(tmp, 'wb') as f:
+    f.write(data)
+  os.replace(tmp, path)
+
+def image_mime(data):
+  """ Detect the image type from its signature. """
+  if data.startswith(b'\xff\xd8'):
+    return 'image/jpeg'
+  if data.startswith(b'\x89PNG'):
+    return 'image/png'
+  raise Exception('Unsupported cover art image type. Expecting JPEG or PNG.')
+
+def resize_image(data, size):
+  """ Resize image to fit within size x size pixels and recompress it as JPEG. """
+  if Image is None:
+    raise Exception('Resizing cover art requires the Pillow package. Aborting.')
+  image = Image.open(io.BytesIO(data))
+  if max(image.size) <= size and image.format == 'JPEG':
+    return data
+  image.thumbnail((size, size))
+  output = io.BytesIO()
+  image.convert('RGB').save(output, format='JPEG', quality=ART_QUALITY, optimize=True)
+  return output.getvalue()
+
+def embed_image(audio, image):
+  """ Embed cover art image in the audio file, to be written with the next save. """
+  data, mime = image
+  if isinstance(audio, (mutagen.flac.FLAC, mutagen.ogg.OggFileType)):
+    picture = mutagen.flac.Picture()
+    picture.type = 3
+    picture.mime = mime
+    picture.data = data
+    if isinstance(audio, mutagen.flac.FLAC):
+      audio.clear_pictures()
+      audio.add_picture(picture)
+    else:
+      audio['metadata_block_picture'] = [base64.b64encode(picture.write()).decode('ascii')]
+  elif isinstance(audio, AudioTags):
+    audio.set_picture(image)
+  else:
+    audio['picture'] = [image]
+
+def write_folder_image(dir, image):
+  """ Write cover art image to the given folder, unless an identical one exists. """
+  data, mime = image
+  path = os.path.join(dir, f'cover.{ART_TYPES[mime]}')
+  with suppress(OSError):
+    with open(path, 'rb') as f:
+      if f.read() == data:
+        return
+  with open(path, 'wb') as f:
+    f.write(data)
+
 def list_files(dir):
-  return sorted(reduce(lambda xs, ys: xs + ys, [
-    glob.glob(os.path.join(glob.escape(dir), '**', f"*.{ext}"), recursive=True) for ext in AUDIO_EXTENSIONS
-  ]))
+  """ List audio files recursively in a single walk, skipping hidden files and folders. """
+  files = []
+  for dirpath, dirnames, filenames in os.walk(dir, followlinks=True):
+    dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith('.')]
+    files += [os.path.join(dirpath, filename) for filename in filenames if not filename.startswith('.') and os.path.splitext(filename)[1][1:] in AUDIO_EXTENSIONS]
+  return sorted(files)
 
 def parse_options(options):
   for skip in SKIP_KEYS:
@@ -415,8 +1996,90 @@ def parse_options(options):
       options['skip_' + skip.lower()] = False
   if not 'dots_as_subtracks' in options:
     options['dots_as_subtracks'] = True
+  if not 'emit' in options:
+    options['emit'] = None
+  if options['emit'] is not None and options['emit'] not in OUTPUT_FORMATS:
+    raise Exception(f'Unknown output format "{options["emit"]}". Expecting one of {", ".join(OUTPUT_FORMATS)}.')
+  for key in ['art', 'art_size', 'cache', 'image', 'timings', 'master']:
+    if not key in options:
+      options[key] = None
+  if options['art'] is not None and options['art'] not in ART_MODES:
+    raise Exception(f'Unknown art mode "{options["art"]}". Expecting one of {", ".join(ART_MODES)}.')
+  if options['emit'] == 'msgpack' and msgpack is None:
+    raise Exception('The msgpack format requires the msgpack package. Aborting.')
   return options
 
+@contextmanager
+def stage(options, name):
+  """ Record the time span and busy time of a processing stage, which can run several times and in several threads. """
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    end = time.perf_counter()
+    if 'stages' in options:
+      with STAGE_LOCK:
+        first, last, busy = options['stages'].get(name, (start, end, 0))
+        options['stages'][name] = (min(first, start), max(last, end), busy + end - start)
+
+def print_stages(options, started):
+  """ Print the recorded stage timings relative to the given start time. """
+  for name, (first, last, busy) in sorted(options['stages'].items(), key=lambda item: item[1][0]):
+    print(f'{name}: {first - started:.3f}s - {last - started:.3f}s ({busy:.3f}s busy)', file=sys.stderr)
+
+def dump_json(data, indent=False):
+  """ Serialize data to JSON, using orjson when available. """
+  if orjson:
+    return orjson.dumps(data, default=str, option=orjson.OPT_INDENT_2 if indent else 0).decode('utf-8')
+  return json.dumps(data, default=str, ensure_ascii=False, indent=2 if indent else None)
+
+def write_output(output):
+  """ Write text or bytes to the standard output and flush it so that records stream out. """
+  if isinstance(output, bytes):
+    sys.stdout.flush()
+    sys.stdout.buffer.write(output)
+    sys.stdout.buffer.flush()
+  else:
+    sys.stdout.write(output)
+    sys.stdout.flush()
+
+def emit_record(record, options, fallback=None):
+  """ Output a single record in the requested output format as soon as it is produced.
+
+  Without an output format, the FALLBACK function is called to produce the legacy output.
+  """
+  format = options.get('emit')
+  if not format:
+    if fallback:
+      fallback()
+    return
+  count = options.get('emitted', 0)
+  options['emitted'] = count + 1
+  if format == 'json':
+    write_output(('[\n' if count == 0 else ',\n') + dump_json(record, indent=True))
+  elif format == 'jsonl':
+    write_output(dump_json(record) + '\n')
+  elif format == 'msgpack':
+    write_output(msgpack.packb(record, default=str))
+  elif format == 'table':
+    def cell(value):
+      if value is None:
+        return ''
+      if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        value = NON_TITLE_SEPARATOR.join(value)
+      if not isinstance(value, str):
+        value = dump_json(value)
+      return value.replace('\t', ' ').replace('\n', ' ')
+    if count == 0:
+      write_output('\t'.join(record.keys()) + '\n')
+    write_output('\t'.join(cell(value) for value in record.values()) + '\n')
+
+def emit_end(options):
+  """ Terminate the output started by emit_record(), if needed. """
+  if options.get('emit') == 'json':
+    write_output('\n]\n' if options.get('emitted', 0) else '[]\n')
+  options['emitted'] = 0
+
 def apply_metadata_track(release, track, audio, n, options):
   def artist_name(artist):
     name = ''
@@ -488,5 +2151,9 @@ def cli():
     'tag': tag,
     'copy': copy,
     'rename': rename,
-    'release': release
+    'release': release,
+    'watch': watch,
+    'batch': batch,
+    'dupes': dupes,
+    'verify': verify
   })
@@ -0,0 +1,124 @@
+""" Generate minimal, tag-less audio files for each supported container.
+
+The files contain valid headers but no actual audio, which is enough for mutagen
+to identify, read and tag them. FLAC files hold frames of silence, so that their
+structure can be verified.
+"""
+import struct
+from mutagen.ogg import OggPage
+from mutagen.mp4 import Atom
+
+def crc(data, bits, poly):
+  value = 0
+  for byte in data:
+    value ^= byte << (bits - 8)
+    for _ in range(8):
+      value = (value << 1) ^ poly if value & (1 << (bits - 1)) else value << 1
+    value &= (1 << bits) - 1
+  return value
+
+def make_flac_frame(number, samples):
+  # Fixed block size, 44100 Hz, two independent channels of 16 bits, with a 16 bits block size for short blocks.
+  header = b'\xff\xf8' + (b'\xc9' if samples == 4096 else b'\x79') + b'\x18'
+  header += bytes([number]) if number < 0x80 else bytes([0xc0 | number >> 6, 0x80 | number & 0x3f])
+  if samples != 4096:
+    header += (samples - 1).to_bytes(2, 'big')
+  header += bytes([crc(header, 8, 0x07)])
+  # A constant subframe of silence for each channel.
+  frame = header + b'\x00\x00\x00' * 2
+  return frame + crc(frame, 16, 0x8005).to_bytes(2, 'big')
+
+def make_flac(path, seconds=1):
+  streaminfo = struct.pack('>HH', 4096, 4096) + b'\x00' * 6
+  # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1, 36 bits total samples.
+  streaminfo += ((44100 << 44) | (1 << 41) | (15 << 36) | (44100 * seconds)).to_bytes(8, 'big')
+  streaminfo += b'\x00' * 16
+  padding = b'\x00' * 1024
+  with open(path, 'wb') as f:
+    f.write(b'fLaC')
+    f.write(b'\x00' + len(streaminfo).to_bytes(3, 'big') + streaminfo)
+    f.write(b'\x81' + len(padding).to_bytes(3, 'big') + padding)
+    for number, sample in enumerate(range(0, 44100 * seconds, 4096)):
+      f.write(make_flac_frame(number, min(4096, 44100 * seconds - sample)))
+
+def make_mp3(path, seconds=1):
+  # MPEG-1 Layer III, 128 kbps, 44100 Hz, stereo: 417 bytes per frame of 1152 samples.
+  frame = b'\xff\xfb\x90\x00' + b'\x00' * 413
+  with open(path, 'wb') as f:
+    f.write(frame * (44100 * seconds // 1152))
+
+def make_ogg_pages(path, packets, granule):
+  pages = []
+  for sequence, packet in enumerate(packets):
+    page = OggPage()
+    page.serial = 1
+    page.sequence = sequence
+    page.first = sequence == 0
+    page.last = sequence == len(packets) - 1
+    page.position = granule if page.last else 0
+    page.packets = [packet]
+    pages.append(page.write())
+  with open(path, 'wb') as f:
+    f.write(b''.join(pages))
+
+def make_ogg(path, seconds=1):
+  identification = b'\x01vorbis' + struct.pack('<IBIiiiBB', 0, 2, 44100, 0, 128000, 0, 0xb8, 1)
+  comment = b'\x03vorbis' + struct.pack('<I', 4) + b'test' + struct.pack('<I', 0) + b'\x01'
+  make_ogg_pages(path, [identification, comment, b'\x00' * 64], 44100 * seconds)
+
+def make_opus(path, seconds=1):
+  head = b'OpusHead' + struct.pack('<BBHIhB', 1, 2, 0, 48000, 0, 0)
+  tags = b'OpusTags' + struct.pack('<I', 4) + b'test' + struct.pack('<I', 0)
+  make_ogg_pages(path, [head, tags, b'\x00' * 64], 48000 * seconds)
+
+def make_m4a(path, seconds=1):
+  def full_atom(name, data):
+    return Atom.render(name, b'\x00\x00\x00\x00' + data)
+  mvhd = full_atom(b'mvhd', struct.pack('>IIII', 0, 0, 44100, 44100 * seconds) + b'\x00' * 80)
+  mdhd = full_atom(b'mdhd', struct.pack('>IIIIHH', 0, 0, 44100, 44100 * seconds, 0, 0))
+  hdlr = full_atom(b'hdlr', struct.pack('>I', 0) + b'soun' + b'\x00' * 13)
+  # Apple Lossless sample entry with its magic cookie.
+  cookie = full_atom(b'alac', struct.pack('>IBBBBBBHIII', 4096, 0, 16, 40, 10, 14, 2, 255, 0, 0, 44100))
+  alac = Atom.render(b'alac', b'\x00' * 6 + struct.pack('>H', 1) + b'\x00' * 8 + struct.pack('>HHHHI', 2, 16, 0, 0, 44100 << 16) + cookie)
+  stsd = full_atom(b'stsd', struct.pack('>I', 1) + alac)
+  stbl = Atom.render(b'stbl', stsd)
+  minf = Atom.render(b'minf', stbl)
+  mdia = Atom.render(b'mdia', mdhd + hdlr + minf)
+  trak = Atom.render(b'trak', mdia)
+  moov = Atom.render(b'moov', mvhd + trak)
+  with open(path, 'wb') as f:
+    f.write(Atom.render(b'ftyp', b'M4A \x00\x00\x00\x00M4A mp42isom'))
+    f.write(moov)
+    f.write(Atom.render(b'mdat', b'\x00' * 4096))
+
+def make_wv(path, seconds=1):
+  # Flags: 16 bits per sample, stereo, 44100 Hz (sample rate index 9).
+  flags = 1 | (9 << 23)
+  data = b'\x00' * 64
+  header = b'wvpk' + struct.pack('<IHBBIIII', 24 + len(data), 0x410, 0, 0, 44100 * seconds, 0, 44100 * seconds, flags) + b'\x00' * 4
+  with open(path, 'wb') as f:
+    f.write(header + data)
+
+def make_aiff(path, seconds=1):
+  # 80-bit extended float for 44100 Hz.
+  rate = b'\x40\x0e\xac\x44\x00\x00\x00\x00\x00\x00'
+  comm = b'COMM' + struct.pack('>IhIh', 18, 2, 44100 * seconds, 16) + rate
+  ssnd = b'SSND' + struct.pack('>III', 8 + 64, 0, 0) + b'\x00' * 64
+  body = b'AIFF' + comm + ssnd
+  with open(path, 'wb') as f:
+    f.write(b'FORM' + struct.pack('>I', len(body)) + body)
+
+AUDIO_MAKERS = {
+  'flac': make_flac,
+  'mp3': make_mp3,
+  'm4a': make_m4a,
+  'ogg': make_ogg,
+  'opus': make_opus,
+  'wv': make_wv,
+  'aiff': make_aiff,
+}
+
+def make_audio(path, seconds=1):
+  """ Create a minimal audio file whose container is deduced from the file extension. """
+  AUDIO_MAKERS[str(path).rsplit('.', 1)[-1]](path, seconds)
+  return str(path)
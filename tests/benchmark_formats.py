@@ -0,0 +1,42 @@
+""" Compare the bytes rewritten by a tag edit across audio containers.
+
+Run with `poetry run python -m tests.benchmark_formats` from the repository root.
+"""
+import os
+import tempfile
+
+from discogs_tag.cli import open_audio, save_audio
+from tests.audio import make_audio, AUDIO_MAKERS
+
+def bytes_rewritten(before, after):
+  """ Count the bytes between the first and last differing byte, up to the end of the file if its size changed. """
+  start = next((n for n, (a, b) in enumerate(zip(before, after)) if a != b), min(len(before), len(after)))
+  if len(before) != len(after):
+    return len(after) - start
+  end = next((n for n, (a, b) in enumerate(zip(reversed(before), reversed(after))) if a != b), len(after))
+  return max(0, len(after) - end - start)
+
+def edit(file, tags):
+  with open(file, 'rb') as f:
+    before = f.read()
+  audio = open_audio(file)
+  for key, value in tags.items():
+    audio[key] = value
+  save_audio(audio)
+  with open(file, 'rb') as f:
+    after = f.read()
+  return len(after), bytes_rewritten(before, after)
+
+def benchmark(seconds=60):
+  print('format\tsize\tfirst edit\tsecond edit\tthird edit')
+  with tempfile.TemporaryDirectory() as dir:
+    for ext in AUDIO_MAKERS:
+      file = make_audio(os.path.join(dir, f'bench.{ext}'), seconds)
+      size = os.path.getsize(file)
+      first = edit(file, { 'title': 'Title', 'artist': 'Artist', 'album': 'Album', 'tracknumber': '1' })
+      second = edit(file, { 'title': 'Eltit' })
+      third = edit(file, { 'title': 'A much longer title that still fits in the padding' * 4 })
+      print(f'{ext}\t{size}\t{first[1]}\t{second[1]}\t{third[1]}')
+
+if __name__ == '__main__':
+  benchmark()
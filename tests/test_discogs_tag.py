@@ -1,3 +1,4 @@
+from discogs_tag import cli
 from discogs_tag.cli import (
   list_files,
   read_metadata,
@@ -7,12 +8,46 @@ from discogs_tag.cli import (
   rename_component,
   rename_path,
   rename_file,
+  rename,
   get_release,
+  release,
+  parse_release,
+  emit_record,
+  emit_end,
+  open_audio,
+  save_audio,
+  cache_image,
+  tag,
+  watch,
+  folder_release,
+  folder_snapshot,
+  batch,
+  parse_shard,
+  dupes,
+  audio_fingerprint,
+  verify,
+  verify_album,
+  pick_version,
+  get_master,
+  RELEASE_KEYS,
+  TAG_KEYS,
 )
 import pytest
+import shutil
+import fire
 import json
+import io
+import os
+import base64
+import hashlib
+import threading
+import time
+import mutagen
+import urllib.error
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from tests.audio import make_audio, AUDIO_MAKERS
 
-def test_list_files():
+def test_list_files(tmp_path):
   files = list_files('tests/glob')
   assert files == [
     'tests/glob/01.mp3',
@@ -23,6 +58,11 @@ def test_list_files():
     'tests/glob/sub2/01.mp3'
   ]
 
+  # Files named after an extension are not audio files.
+  (tmp_path / 'mp3').write_bytes(b'')
+  (tmp_path / 'a.mp3').write_bytes(b'')
+  assert list_files(str(tmp_path)) == [str(tmp_path / 'a.mp3')]
+
 def test_read_metadata():
   release = read_metadata([{
     'artist': ['Artist'],
@@ -409,3 +449,767 @@ def test_get_release():
   assert json.load(get_release('16215626'))['id'] == 16215626
   assert json.load(get_release('https://api.discogs.com/releases/16215626'))['id'] == 16215626
   assert json.load(get_release('https://www.discogs.com/release/16215626-Pink-Floyd-Wish-You-Were-Here'))['id'] == 16215626
+
+def test_parse_release():
+  for filename in ['tests/16215626.json', 'tests/17717578.json', 'tests/8582788.json']:
+    with open(filename) as release:
+      expected = { key: value for key, value in json.load(release).items() if key in RELEASE_KEYS }
+    for chunk_size in [1, 7, 4096, 1024 * 1024]:
+      with open(filename, 'rb') as release:
+        assert parse_release(release, chunk_size=chunk_size) == expected
+
+  assert parse_release(io.BytesIO(b' { "year" : 1975, "id": 12 } ')) == { 'year': 1975 }
+  assert parse_release(io.BytesIO('{"title":"Café","notes":[1, {"a": "}"}]}'.encode('utf-8')), chunk_size=1) == { 'title': 'Café' }
+  assert parse_release(io.BytesIO(b'{}')) == {}
+  with pytest.raises(Exception):
+    parse_release(io.BytesIO(b'{"title": "Unterminated'))
+  with pytest.raises(Exception) as error:
+    parse_release(io.BytesIO(b'[]'))
+  assert "Invalid release JSON" in str(error.value)
+
+def test_release_raw(capsysbinary):
+  release('file:tests/16215626.json', raw=True)
+  with open('tests/16215626.json', 'rb') as expected:
+    assert capsysbinary.readouterr().out == expected.read()
+
+def test_output_formats(mocker, capsys):
+  mutagen_file_mock = mocker.patch('mutagen.File')
+  mutagen_file_mock.return_value = {}
+  with open('tests/17717578.json') as release:
+    data = json.load(release)
+  options = parse_options({ 'dry': True, 'skip': None, 'emit': 'jsonl' })
+  apply_metadata(data, [f'{n:02d}.flac' for n in range(16)], options)
+  records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+  assert len(records) == 16
+  assert records[9] == { 'file': '09.flac', 'tags': records[9]['tags'] }
+  assert records[9]['tags']['title'] == 'Adivinha O Quê?'
+  assert records[9]['tags']['tracknumber'] == '10'
+
+  options = parse_options({ 'emit': 'json' })
+  emit_end(options)
+  assert json.loads(capsys.readouterr().out) == []
+  emit_record({ 'op': 'move', 'src': 'a', 'dst': 'b' }, options)
+  emit_record({ 'op': 'remove', 'src': 'c', 'dst': None }, options)
+  emit_end(options)
+  assert json.loads(capsys.readouterr().out) == [{ 'op': 'move', 'src': 'a', 'dst': 'b' }, { 'op': 'remove', 'src': 'c', 'dst': None }]
+
+  options = parse_options({ 'emit': 'table' })
+  emit_record({ 'file': 'a.flac', 'tags': { 'title': ['Title'] } }, options)
+  emit_record({ 'file': 'b\tc.flac', 'tags': None }, options)
+  assert capsys.readouterr().out == 'file\ttags\na.flac\t{"title":["Title"]}\nb c.flac\t\n'
+
+  options = parse_options({ 'dry': True, 'skip': None, 'emit': 'table' })
+  apply_metadata(data, [f'{n:02d}.flac' for n in range(16)], options)
+  rows = [line.split('\t') for line in capsys.readouterr().out.splitlines()]
+  assert rows[0] == ['file'] + TAG_KEYS
+  assert dict(zip(rows[0], rows[10]))['title'] == 'Adivinha O Quê?'
+
+  options = parse_options({ 'dry': True })
+  emit_record({ 'file': 'a.flac' }, options, lambda: print('legacy'))
+  assert capsys.readouterr().out == 'legacy\n'
+
+  with pytest.raises(Exception) as error:
+    parse_options({ 'emit': 'xml' })
+  assert 'Unknown output format "xml"' in str(error.value)
+
+def test_output_msgpack(capsysbinary):
+  msgpack = pytest.importorskip('msgpack')
+  options = parse_options({ 'emit': 'msgpack' })
+  emit_record({ 'op': 'move', 'src': 'a', 'dst': 'b' }, options)
+  emit_record({ 'op': 'remove', 'src': 'c', 'dst': None }, options)
+  emit_end(options)
+  assert list(msgpack.Unpacker(io.BytesIO(capsysbinary.readouterr().out))) == [{ 'op': 'move', 'src': 'a', 'dst': 'b' }, { 'op': 'remove', 'src': 'c', 'dst': None }]
+
+def test_output_flags(tmp_path, mocker, capsys):
+  # The -o short flag still selects the ONLY keys.
+  apply = mocker.patch('discogs_tag.cli.apply_metadata')
+  fire.Fire(cli.tag, command=['file:tests/17717578.json', '--dir', str(tmp_path), '-o', 'title'])
+  options = apply.call_args.args[2]
+  assert not options['skip_title'] and options['skip_artist']
+
+  # Tagging with an output format keeps the standard output valid.
+  mocker.stopall()
+  make_album(tmp_path, 'Album', 2, None)
+  tag(write_release(tmp_path / 'release.json', '', 2), dir=str(tmp_path / 'Album'), emit='json')
+  captured = capsys.readouterr()
+  assert json.loads(captured.out) == []
+  assert 'Processed 2 audio files.' in captured.err
+
+@pytest.mark.parametrize('ext', AUDIO_MAKERS.keys())
+def test_audio_formats(tmp_path, ext):
+  file = make_audio(tmp_path / f'01.{ext}')
+  assert list_files(str(tmp_path)) == [file]
+
+  audio = open_audio(file)
+  assert audio.info.length == pytest.approx(1, abs=0.1)
+  audio = apply_metadata_track({
+    'year': 2002,
+    'title': 'Album',
+    'artists': [{ 'name': 'Album Artist' }],
+    'genres': ['Jazz'],
+  }, {
+    'title': 'Title',
+    'position': '1-02',
+    'extraartists': [{
+      'role': 'Composed By',
+      'name': 'Composer'
+    }]
+  }, audio, 2, parse_options({ 'skip': None }))
+  save_audio(audio)
+
+  audio = open_audio(file)
+  assert audio['title'] == ['Title']
+  assert audio['artist'] == ['Album Artist']
+  assert audio['albumartist'] == ['Album Artist']
+  assert audio['album'] == ['Album']
+  assert audio['composer'] == ['Composer']
+  assert audio['genre'] == ['Jazz']
+  assert int(audio['tracknumber'][0].split('/')[0]) == 2
+  assert audio['discnumber'][0].split('/')[0] == '1'
+  assert audio['date'] == ['2002']
+
+  # A second edit of the same size fits in the existing tag space without growing the file.
+  size = os.path.getsize(file)
+  audio['title'] = 'Eltit'
+  save_audio(audio)
+  assert os.path.getsize(file) == size
+  assert open_audio(file)['title'] == ['Eltit']
+
+def serve(directory):
+  """ Serve a folder over HTTP, counting the requests. """
+  requests = []
+  class Handler(SimpleHTTPRequestHandler):
+    def __init__(self, *args, **kwargs):
+      super().__init__(*args, directory=directory, **kwargs)
+    def do_GET(self):
+      requests.append(self.path)
+      super().do_GET()
+    def log_message(self, *args):
+      pass
+  server = HTTPServer(('127.0.0.1', 0), Handler)
+  thread = threading.Thread(target=server.serve_forever, daemon=True)
+  thread.start()
+  yield f'http://127.0.0.1:{server.server_address[1]}', requests
+  server.shutdown()
+  server.server_close()
+
+@pytest.fixture
+def image_server():
+  yield from serve('tests')
+
+@pytest.fixture
+def api_server(tmp_path):
+  """ Serve a stub Discogs API from a temporary folder. """
+  (tmp_path / 'api').mkdir()
+  yield from serve(str(tmp_path / 'api'))
+
+def write_release(path, url, tracks):
+  with open(path, 'w') as f:
+    json.dump({
+      'title': 'Album',
+      'year': 2002,
+      'artists': [{ 'name': 'Artist' }],
+      'images': [
+        { 'type': 'secondary', 'uri': f'{url}/back.png' },
+        { 'type': 'primary', 'uri': f'{url}/cover.jpg' }
+      ],
+      'tracklist': [{ 'type_': 'track', 'position': str(n + 1), 'title': f'Track {n + 1}' } for n in range(tracks)]
+    }, f)
+  return f'file:{path}'
+
+def test_cache_image(tmp_path, image_server):
+  url, requests = image_server
+  options = parse_options({ 'art': 'embed', 'cache': str(tmp_path) })
+  with open('tests/cover.jpg', 'rb') as f:
+    cover = f.read()
+  assert cache_image(f'{url}/cover.jpg', options) == (cover, 'image/jpeg')
+  assert cache_image(f'{url}/cover.jpg', options) == (cover, 'image/jpeg')
+  assert requests == ['/cover.jpg']
+  assert os.path.exists(tmp_path / 'objects' / cover_digest(cover)[:2] / cover_digest(cover))
+
+  # Same content under another URI is stored once.
+  assert cache_image(f'{url}/cover.jpg?copy', options) == (cover, 'image/jpeg')
+  assert requests == ['/cover.jpg', '/cover.jpg?copy']
+  assert len(list((tmp_path / 'objects').glob('*/*'))) == 1
+  assert len(list((tmp_path / 'refs').glob('*'))) == 2
+
+def test_cache_image_resize(tmp_path, image_server):
+  Image = pytest.importorskip('PIL.Image')
+  url, requests = image_server
+  options = parse_options({ 'art': 'embed', 'cache': str(tmp_path), 'art_size': 100 })
+  data, mime = cache_image(f'{url}/back.png', options)
+  assert mime == 'image/jpeg'
+  assert Image.open(io.BytesIO(data)).size == (100, 100)
+  assert cache_image(f'{url}/back.png', parse_options({ 'cache': str(tmp_path) }))[1] == 'image/png'
+  assert requests == ['/back.png', '/back.png']
+
+def cover_digest(data):
+  return hashlib.sha256(data).hexdigest()
+
+def embedded_images(file):
+  audio = mutagen.File(file)
+  if isinstance(audio, mutagen.flac.FLAC):
+    return [picture.data for picture in audio.pictures]
+  if isinstance(audio, mutagen.ogg.OggFileType):
+    return [mutagen.flac.Picture(base64.b64decode(value)).data for value in audio.get('metadata_block_picture', [])]
+  if isinstance(audio, mutagen.mp4.MP4):
+    return [bytes(cover) for cover in audio.tags.get('covr', [])]
+  if isinstance(audio, mutagen.apev2.APEv2File):
+    return [audio.tags['Cover Art (Front)'].value.split(b'\x00', 1)[1]] if 'Cover Art (Front)' in audio.tags else []
+  return [frame.data for frame in audio.tags.getall('APIC')]
+
+@pytest.mark.parametrize('ext', AUDIO_MAKERS.keys())
+def test_tag_art_embed(tmp_path, image_server, ext):
+  url, requests = image_server
+  dir = tmp_path / 'album'
+  dir.mkdir()
+  files = [make_audio(dir / f'0{n}.{ext}') for n in range(1, 3)]
+  release = write_release(tmp_path / 'release.json', url, 2)
+  tag(release, dir=str(dir), art='embed', cache=str(tmp_path / 'cache'))
+  tag(release, dir=str(dir), art='embed', cache=str(tmp_path / 'cache'))
+  assert requests == ['/cover.jpg']
+  with open('tests/cover.jpg', 'rb') as f:
+    cover = f.read()
+  for n, file in enumerate(files):
+    assert embedded_images(file) == [cover]
+    assert open_audio(file)['title'] == [f'Track {n + 1}']
+  assert not os.path.exists(dir / 'cover.jpg')
+
+def test_tag_art_folder(tmp_path, image_server):
+  url, requests = image_server
+  for sub in ['cd1', 'cd2']:
+    (tmp_path / 'album' / sub).mkdir(parents=True)
+    make_audio(tmp_path / 'album' / sub / '01.flac')
+  release = write_release(tmp_path / 'release.json', url, 2)
+  tag(release, dir=str(tmp_path / 'album'), art='folder', cache=str(tmp_path / 'cache'))
+  with open('tests/cover.jpg', 'rb') as f:
+    cover = f.read()
+  for sub in ['cd1', 'cd2']:
+    with open(tmp_path / 'album' / sub / 'cover.jpg', 'rb') as f:
+      assert f.read() == cover
+    assert embedded_images(tmp_path / 'album' / sub / '01.flac') == []
+
+  with pytest.raises(Exception) as error:
+    parse_options({ 'art': 'sideways' })
+  assert 'Unknown art mode "sideways"' in str(error.value)
+
+def make_album(root, name, tracks, release):
+  dir = root / name
+  dir.mkdir()
+  for n in range(tracks):
+    make_audio(dir / f'0{n + 1}.flac')
+  if release:
+    with open(dir / 'release.txt', 'w') as f:
+      f.write(release)
+  return dir
+
+def test_folder_release(tmp_path):
+  assert folder_release(str(make_album(tmp_path, 'Album [16215626]', 0, None))) == '16215626'
+  assert folder_release(str(make_album(tmp_path, 'Album [r16215626] ', 0, None))) == '16215626'
+  assert folder_release(str(make_album(tmp_path, 'Album', 0, 'file:release.json\n'))) == 'file:release.json'
+  assert folder_release(str(make_album(tmp_path, 'Album 16215626', 0, None))) is None
+
+def test_folder_snapshot(tmp_path):
+  dir = make_album(tmp_path, 'Album', 2, 'file:release.json')
+  snapshot = folder_snapshot(str(dir))
+  assert snapshot[:2] == [3, os.path.getsize(dir / '01.flac') * 2 + len('file:release.json')]
+  with open(dir / '02.flac', 'ab') as f:
+    f.write(b'\x00')
+  assert folder_snapshot(str(dir)) != snapshot
+
+@pytest.mark.parametrize('poll', [True, False])
+def test_watch(tmp_path, mocker, poll):
+  if not poll:
+    pytest.importorskip('inotify_simple')
+  root = tmp_path / 'ingest'
+  root.mkdir()
+  release = write_release(tmp_path / 'release.json', '', 2)
+  make_album(root, 'Album', 2, release)
+  make_album(root, 'Broken', 3, release)
+  make_album(root, 'Unknown', 2, None)
+  second = write_release(tmp_path / 'second.json', '', 2)
+  with open(tmp_path / 'second.json') as f:
+    data = json.load(f)
+  with open(tmp_path / 'second.json', 'w') as f:
+    json.dump(dict(data, title='Second'), f)
+  make_album(root, 'Second', 2, second)
+  process = mocker.spy(cli, 'process_watch_folder')
+
+  watch(str(root), format='%z/%b/%n %t', settle=0, interval=0.05, poll=poll, once=True)
+  assert sorted(os.listdir(root / 'Artist' / 'Album')) == ['01 Track 1.flac', '02 Track 2.flac']
+  assert sorted(os.listdir(root / 'Artist' / 'Second')) == ['01 Track 1.flac', '02 Track 2.flac']
+  assert os.path.exists(root / 'Artist' / 'release.txt')
+  assert not os.path.exists(root / 'Album')
+  assert open_audio(str(root / 'Artist' / 'Album' / '02 Track 2.flac'))['title'] == ['Track 2']
+  assert open_audio(str(root / 'Artist' / 'Second' / '02 Track 2.flac'))['album'] == ['Second']
+  # The shared rename destination is never processed as a new album.
+  assert [call.args[0] for call in process.call_args_list] == [str(root / 'Album'), str(root / 'Broken'), str(root / 'Second')]
+
+  with open(root / '.discogs-tag.json') as f:
+    state = json.load(f)
+  assert state[str(root / 'Album')]['result'] == 'done'
+  assert state[str(root / 'Artist')]['result'] == 'output'
+  assert state[str(root / 'Broken')]['result'] == 'failed'
+  assert 'Expecting 2 files but found 3' in state[str(root / 'Broken')]['error']
+  assert str(root / 'Unknown') not in state
+
+  # Restarting does not reprocess anything, until a folder changes.
+  watch(str(root), format='%z/%b/%n %t', settle=0, interval=0.05, poll=poll, once=True)
+  assert process.call_count == 3
+  os.remove(root / 'Broken' / '03.flac')
+  watch(str(root), settle=0, interval=0.05, poll=poll, once=True)
+  assert process.call_count == 4
+  with open(root / '.discogs-tag.json') as f:
+    assert json.load(f)[str(root / 'Broken')]['result'] == 'done'
+
+  # Changes inside nested folders are detected too.
+  (root / 'Broken' / 'CD2').mkdir()
+  make_audio(root / 'Broken' / 'CD2' / '01.flac')
+  watch(str(root), settle=0, interval=0.05, poll=poll, once=True)
+  assert process.call_count == 5
+  make_audio(root / 'Broken' / 'CD2' / '02.flac')
+  watch(str(root), settle=0, interval=0.05, poll=poll, once=True)
+  assert process.call_count == 6
+
+def test_watch_dry(tmp_path):
+  root = tmp_path / 'ingest'
+  root.mkdir()
+  make_album(root, 'Album', 2, write_release(tmp_path / 'release.json', '', 2))
+
+  watch(str(root), dry=True, settle=0, interval=0.05, poll=True, once=True)
+  assert not os.path.exists(root / '.discogs-tag.json')
+  assert 'title' not in open_audio(str(root / 'Album' / '01.flac'))
+
+  # A real run after a dry run still processes the folders.
+  watch(str(root), settle=0, interval=0.05, poll=True, once=True)
+  assert open_audio(str(root / 'Album' / '01.flac'))['title'] == ['Track 1']
+
+def test_watch_copy(tmp_path):
+  root = tmp_path / 'ingest'
+  root.mkdir()
+  make_album(root, 'Album', 2, write_release(tmp_path / 'a.json', '', 2))
+  other = write_release(tmp_path / 'b.json', '', 2)
+  with open(tmp_path / 'b.json') as f:
+    data = json.load(f)
+  with open(tmp_path / 'b.json', 'w') as f:
+    json.dump(dict(data, title='Other'), f)
+  watch(str(root), settle=0, interval=0.05, poll=True, once=True)
+
+  # A copy with the same files but another release is not mistaken for the processed folder.
+  shutil.copytree(root / 'Album', root / 'Copy')
+  stat = os.stat(root / 'Copy' / 'release.txt')
+  (root / 'Copy' / 'release.txt').write_text(other)
+  os.utime(root / 'Copy' / 'release.txt', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+  assert folder_snapshot(str(root / 'Copy')) == folder_snapshot(str(root / 'Album'))
+  watch(str(root), settle=0, interval=0.05, poll=True, once=True)
+  assert open_audio(str(root / 'Copy' / '01.flac'))['album'] == ['Other']
+  with open(root / '.discogs-tag.json') as f:
+    assert json.load(f)[str(root / 'Copy')]['release'] == other
+
+def test_watch_state_error(tmp_path, mocker, capsys):
+  root = tmp_path / 'ingest'
+  root.mkdir()
+  make_album(root, 'Album', 2, write_release(tmp_path / 'release.json', '', 2))
+  mocker.patch('discogs_tag.cli.save_watch_state', side_effect=OSError('No space left on device'))
+
+  # The worker survives the error, so that the watcher still exits.
+  thread = threading.Thread(target=watch, args=(str(root),), kwargs={ 'settle': 0, 'interval': 0.05, 'poll': True, 'once': True }, daemon=True)
+  thread.start()
+  thread.join(timeout=10)
+  assert not thread.is_alive()
+  assert 'No space left on device' in capsys.readouterr().err
+
+def test_tag_pipeline(tmp_path, mocker, capsys):
+  dir = make_album(tmp_path, 'Album', 4, None)
+  release = write_release(tmp_path / 'release.json', '', 4)
+  get_release = cli.get_release
+  open_audio = cli.open_audio
+  def slow_get_release(release):
+    time.sleep(0.3)
+    return get_release(release)
+  def slow_open_audio(file):
+    time.sleep(0.2)
+    return open_audio(file)
+  mocker.patch('discogs_tag.cli.get_release', slow_get_release)
+  mocker.patch('discogs_tag.cli.open_audio', slow_open_audio)
+
+  tag(release, dir=str(dir), timings=True)
+  assert open_audio(str(dir / '04.flac'))['title'] == ['Track 4']
+
+  stages = {}
+  for line in capsys.readouterr().err.splitlines():
+    name, span = line.split(': ', 1)
+    stages[name] = [float(t.rstrip('s')) for t in span.split(' (')[0].split(' - ')]
+  assert set(stages) == { 'release', 'scan', 'read', 'map', 'write' }
+  # Files are read while the release is fetched.
+  assert stages['read'][0] < stages['release'][1]
+
+def test_tag_read_ahead(tmp_path, mocker):
+  dir = make_album(tmp_path, 'Album', 9, None)
+  release = write_release(tmp_path / 'release.json', '', 9)
+  counts = { 'read': 0, 'written': 0, 'ahead': 0 }
+  open_audio = cli.open_audio
+  save_audio = cli.save_audio
+  def counting_open_audio(file):
+    counts['read'] += 1
+    return open_audio(file)
+  def counting_save_audio(audio):
+    counts['ahead'] = max(counts['ahead'], counts['read'] - counts['written'])
+    counts['written'] += 1
+    save_audio(audio)
+  mocker.patch('discogs_tag.cli.open_audio', counting_open_audio)
+  mocker.patch('discogs_tag.cli.save_audio', counting_save_audio)
+  mocker.patch('discogs_tag.cli.TAG_READERS', 1)
+
+  tag(release, dir=str(dir))
+  # At most 2 files are read ahead of the one being written.
+  assert counts['read'] == 9 and counts['written'] == 9
+  assert counts['ahead'] <= 3
+
+def test_batch(tmp_path, mocker, capsys):
+  root = tmp_path / 'library'
+  root.mkdir()
+  release = write_release(tmp_path / 'release.json', '', 2)
+  for n in range(6):
+    make_album(root, f'Album {n}', 2, release)
+  make_album(root, 'Broken', 3, release)
+  process = mocker.spy(cli, 'tag')
+
+  batch(str(root))
+  assert process.call_count == 7
+  assert 'Processed 6 folders, 1 failed, 0 skipped, 0 busy.' in capsys.readouterr().out
+  with open(root / '.discogs-tag.log') as f:
+    entries = [json.loads(line) for line in f]
+  assert sorted((entry['folder'], entry['status']) for entry in entries) == [(f'Album {n}', 'done') for n in range(6)] + [('Broken', 'failed')]
+  assert all(entry['release'] == release and len(entry['hash']) == 64 for entry in entries)
+
+  # Completed folders are skipped, failed or changed ones are processed again.
+  os.remove(root / 'Broken' / '03.flac')
+  open_audio(str(root / 'Album 0' / '01.flac')).save()
+  batch(str(root))
+  assert process.call_count == 9
+  assert 'Processed 2 folders, 0 failed, 5 skipped, 0 busy.' in capsys.readouterr().out
+  batch(str(root))
+  assert process.call_count == 9
+
+def test_batch_shards(tmp_path, mocker):
+  root = tmp_path / 'library'
+  root.mkdir()
+  release = write_release(tmp_path / 'release.json', '', 1)
+  for n in range(10):
+    make_album(root, f'Album {n}', 1, release)
+  process = mocker.spy(cli, 'tag')
+
+  shards = []
+  for index in range(3):
+    batch(str(root), shard=f'{index}/3', checkpoint=str(tmp_path / f'{index}.log'))
+    shards.append(sorted(call.kwargs['dir'] for call in process.call_args_list))
+    process.reset_mock()
+  assert sorted(sum(shards, [])) == sorted(str(root / f'Album {n}') for n in range(10))
+  assert all(shards)
+
+  assert parse_shard(None) == (0, 1)
+  assert parse_shard('2/4') == (2, 4)
+  for shard in ['4/4', '-1/4', '1', 'a/b']:
+    with pytest.raises(Exception) as error:
+      parse_shard(shard)
+    assert f'Invalid shard "{shard}"' in str(error.value)
+
+def test_batch_claim(tmp_path, mocker, capsys):
+  fcntl = pytest.importorskip('fcntl')
+  root = tmp_path / 'library'
+  root.mkdir()
+  release = write_release(tmp_path / 'release.json', '', 1)
+  make_album(root, 'Album', 1, release)
+  make_album(root, 'Claimed', 1, release)
+  process = mocker.spy(cli, 'tag')
+
+  # Simulate another node holding the claim on a folder.
+  locks = root / '.discogs-tag.log.locks'
+  locks.mkdir()
+  with open(locks / hashlib.sha1(b'Claimed').hexdigest(), 'a') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    batch(str(root))
+  assert [call.kwargs['dir'] for call in process.call_args_list] == [str(root / 'Album')]
+  assert 'Processed 1 folders, 0 failed, 0 skipped, 1 busy.' in capsys.readouterr().out
+  # Only the lock held by the other node remains.
+  assert os.listdir(locks) == [hashlib.sha1(b'Claimed').hexdigest()]
+
+  batch(str(root))
+  assert 'Processed 1 folders, 0 failed, 1 skipped, 0 busy.' in capsys.readouterr().out
+  assert os.listdir(locks) == []
+
+def test_batch_copy(tmp_path):
+  (tmp_path / 'src').mkdir()
+  (tmp_path / 'dst').mkdir()
+  release = write_release(tmp_path / 'release.json', '', 2)
+  tag(release, dir=str(make_album(tmp_path / 'src', 'Album', 2, None)))
+  make_album(tmp_path / 'dst', 'Album', 2, None)
+  make_album(tmp_path / 'dst', 'Other', 2, None)
+  batch(str(tmp_path / 'dst'), src=str(tmp_path / 'src'))
+  assert open_audio(str(tmp_path / 'dst' / 'Album' / '02.flac'))['title'] == ['Track 2']
+  assert 'title' not in open_audio(str(tmp_path / 'dst' / 'Other' / '02.flac'))
+
+def test_audio_fingerprint(tmp_path):
+  for ext in ['flac', 'mp3']:
+    file = make_audio(tmp_path / f'01.{ext}')
+    fingerprint = audio_fingerprint(file)
+    assert fingerprint.startswith(f'{ext}-frames:')
+    audio = open_audio(file)
+    audio['title'] = 'Title' * 1000
+    save_audio(audio)
+    assert audio_fingerprint(file) == fingerprint
+    assert audio_fingerprint(make_audio(tmp_path / f'02.{ext}', 2)) != fingerprint
+
+  # The STREAMINFO MD5 is used when present.
+  file = make_audio(tmp_path / '03.flac')
+  with open(file, 'r+b') as f:
+    f.seek(4 + 4 + 18)
+    f.write(bytes(range(1, 17)))
+  assert audio_fingerprint(file) == 'flac:' + bytes(range(1, 17)).hex()
+  assert audio_fingerprint(make_audio(tmp_path / '01.ogg')) is None
+
+def test_dupes(tmp_path, mocker, capsys):
+  root = tmp_path / 'library'
+  for album in ['A', 'B', 'C']:
+    (root / album).mkdir(parents=True)
+    make_audio(root / album / '01.flac', 3 if album == 'C' else 1)
+    make_audio(root / album / '02.mp3', 2)
+  make_audio(root / 'C' / '03.mp3', 3)
+  audio = open_audio(str(root / 'B' / '01.flac'))
+  audio['title'] = 'Tagged'
+  save_audio(audio)
+  index = str(tmp_path / 'index.sqlite')
+
+  dupes(str(root), index=index, emit='jsonl')
+  records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+  assert [(record['type'], record['paths']) for record in records] == [
+    ('file', [str(root / 'A' / '01.flac'), str(root / 'B' / '01.flac')]),
+    ('file', [str(root / 'A' / '02.mp3'), str(root / 'B' / '02.mp3'), str(root / 'C' / '02.mp3')]),
+    ('album', [str(root / 'A'), str(root / 'B')])
+  ]
+
+  # Unchanged files are not hashed again, and earlier runs are taken into account.
+  mocker.patch('discogs_tag.cli.audio_fingerprint', side_effect=Exception('Should not hash'))
+  dupes(str(root / 'C'), index=index)
+  assert capsys.readouterr().out == '= %s\n  %s\n  %s\n' % (root / 'A' / '02.mp3', root / 'B' / '02.mp3', root / 'C' / '02.mp3')
+
+def test_batch_dedupe(tmp_path, mocker, capsys):
+  root = tmp_path / 'library'
+  root.mkdir()
+  release = write_release(tmp_path / 'release.json', '', 2)
+  make_album(root, 'Album', 2, release)
+  make_album(root, 'Album (copy)', 2, release)
+  for name in ['Live', 'Live (copy)']:
+    (root / name).mkdir()
+    (root / name / 'release.txt').write_text(release)
+    for n in range(2):
+      make_audio(root / name / f'0{n + 1}.mp3', n + 1)
+  process = mocker.spy(cli, 'tag')
+  pool = mocker.patch('discogs_tag.cli.ProcessPoolExecutor', wraps=cli.ProcessPoolExecutor)
+
+  batch(str(root), dedupe=True, index=str(tmp_path / 'index.sqlite'))
+  assert [call.kwargs['dir'] for call in process.call_args_list] == [str(root / 'Album'), str(root / 'Live')]
+  assert f'already tagged with release {release} in "{root / "Album"}"' in capsys.readouterr().err
+  with open(root / '.discogs-tag.log') as f:
+    assert [json.loads(line)['status'] for line in f] == ['done', 'duplicate', 'done', 'duplicate']
+  # A single process pool hashes the MP3 files of all folders.
+  assert pool.call_count == 1
+
+def test_batch_dedupe_edited(tmp_path, mocker, capsys):
+  root = tmp_path / 'library'
+  root.mkdir()
+  other = tmp_path / 'other'
+  other.mkdir()
+  release = write_release(tmp_path / 'release.json', '', 2)
+  album = make_album(root, 'Album', 2, release)
+  make_album(other, 'Copy', 2, release)
+  index = str(tmp_path / 'index.sqlite')
+  batch(str(root), dedupe=True, index=index)
+  process = mocker.spy(cli, 'tag')
+
+  # Files edited outside the tool no longer count as tagged, not even as a copy of themselves.
+  def wipe():
+    for file in album.glob('*.flac'):
+      mutagen.File(file).delete()
+  wipe()
+  batch(str(root), dedupe=True, index=index)
+  assert [call.kwargs['dir'] for call in process.call_args_list] == [str(album)]
+  wipe()
+  batch(str(other), dedupe=True, index=index)
+  assert [call.kwargs['dir'] for call in process.call_args_list] == [str(album), str(other / 'Copy')]
+  assert 'already tagged' not in capsys.readouterr().err
+
+def test_verify(tmp_path, capsys):
+  release = write_release(tmp_path / 'release.json', '', 4)
+  root = tmp_path / 'library'
+  album = root / 'Album'
+  album.mkdir(parents=True)
+  for n, ext in enumerate(['flac', 'mp3', 'flac', 'mp3']):
+    make_audio(album / f'0{n + 1}.{ext}')
+  tag(release, dir=str(album))
+  capsys.readouterr()
+
+  verify(str(root), workers=2)
+  records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+  assert [(record['type'], record['ok']) for record in records] == [('file', True)] * 4 + [('album', True)]
+
+  # Truncated MP3, corrupted FLAC header and inconsistent tags.
+  with open(album / '02.mp3', 'r+b') as f:
+    f.truncate(os.path.getsize(album / '02.mp3') - 1000)
+  with open(album / '03.flac', 'r+b') as f:
+    f.write(b'fLaX')
+  audio = open_audio(str(album / '04.mp3'))
+  audio['album'] = 'Other'
+  save_audio(audio)
+  with pytest.raises(Exception) as error:
+    verify(str(root), workers=2)
+  records = { record['path']: record for record in map(json.loads, capsys.readouterr().out.splitlines()) }
+  assert records[str(album / '01.flac')]['ok']
+  assert records[str(album / '02.mp3')]['errors'][0].startswith('Truncated frame at offset')
+  assert records[str(album / '03.flac')]['errors'][0] == 'Missing FLAC signature'
+  assert records[str(album / '04.mp3')]['ok']
+  assert records[str(album)]['errors'][0] == 'Inconsistent album: Album, Other'
+  assert 'Found' in str(error.value)
+
+def test_verify_flac(tmp_path, capsys):
+  album = tmp_path / 'Album'
+  album.mkdir()
+  # The last frame of silence is 16 bytes long, as it has an explicit block size.
+  for name, cut in [('01.flac', 0), ('02.flac', 101), ('03.flac', 16)]:
+    make_audio(album / name, 3)
+    with open(album / name, 'r+b') as f:
+      f.truncate(os.path.getsize(album / name) - cut)
+  with pytest.raises(Exception):
+    verify(str(tmp_path))
+  records = { record['path']: record for record in map(json.loads, capsys.readouterr().out.splitlines()) }
+  assert records[str(album / '01.flac')]['errors'] == []
+  assert records[str(album / '02.flac')]['errors'] == ['Truncated last frame']
+  assert records[str(album / '03.flac')]['errors'] == ['Truncated audio: 131072 of 132300 samples']
+
+def test_verify_album():
+  def tags(*positions, **extra):
+    return [dict({ 'album': 'Album', 'albumartist': 'Artist', 'date': '2002', 'tracknumber': position.split('-')[-1], 'discnumber': position.split('-')[0] if '-' in position else '' }, **extra) for position in positions]
+  assert verify_album(tags('1', '2', '3')) == []
+  assert verify_album(tags('1-1', '1-2', '2-1')) == []
+  assert verify_album(tags('2-1', '2-2')) == []
+  assert verify_album(tags('A1', 'A2', 'B1')) == []
+  assert verify_album(tags('1', '3')) == ['Non-contiguous tracknumbers: 1, 3']
+  assert verify_album(tags('1', '1')) == ['Non-contiguous tracknumbers: 1, 1']
+  assert verify_album(tags('1-1', '3-1')) == ['Non-contiguous discnumbers: 1, 3']
+  assert verify_album(tags('1-1', '2')) == ['Missing discnumber on some tracks', 'Non-contiguous tracknumbers: 2']
+  assert verify_album(tags('1') + tags('2', date='2003')) == ['Inconsistent date: 2002, 2003']
+
+def test_rename_syscalls(tmp_path, mocker):
+  src = make_album(tmp_path, 'in', 4, None)
+  tag(write_release(tmp_path / 'release.json', '', 4), dir=str(src))
+  (src / 'Scans').mkdir()
+  (src / 'Scans' / 'front.jpg').write_bytes(b'')
+  (src / 'Scans' / 'back.jpg').write_bytes(b'')
+  syscalls = { name: mocker.spy(os, name) for name in ['mkdir', 'makedirs', 'rmdir', 'rename'] }
+  realpath = mocker.spy(os.path, 'realpath')
+
+  rename('%z/%b/%n %t', dir=str(src))
+  # Each destination folder is created once, and only emptied source folders are removed.
+  assert syscalls['mkdir'].call_count == 3
+  assert syscalls['makedirs'].call_count == 0
+  assert syscalls['rmdir'].call_count == 2
+  assert syscalls['rename'].call_count == 6
+  assert realpath.call_count == 1
+  assert sorted(os.listdir(tmp_path / 'Artist' / 'Album')) == ['01 Track 1.flac', '02 Track 2.flac', '03 Track 3.flac', '04 Track 4.flac']
+  assert sorted(os.listdir(tmp_path / 'Artist' / 'Scans')) == ['back.jpg', 'front.jpg']
+  assert not src.exists()
+
+def write_version(path, url, title, positions, duration):
+  with open(path, 'w') as f:
+    json.dump({
+      'title': title,
+      'artists': [{ 'name': 'Artist' }],
+      'tracklist': [{ 'type_': 'track', 'position': position, 'title': f'Track {position}', 'duration': duration } for position in positions]
+    }, f)
+  return { 'id': int(path.stem), 'resource_url': f'{url}/{path.name}' }
+
+def test_tag_master(tmp_path, api_server, mocker):
+  url, requests = api_server
+  api = tmp_path / 'api'
+  versions = [
+    write_version(api / '1.json', url, 'Short', ['1', '2', '3'], '0:01'),
+    write_version(api / '2.json', url, 'Single Disc', ['1', '2', '3', '4'], '0:01'),
+    write_version(api / '3.json', url, 'Edit', ['1-1', '1-2', '2-1', '2-2'], '0:05'),
+    write_version(api / '4.json', url, 'Album', ['1-1', '1-2', '2-1', '2-2'], '0:01'),
+    { 'id': 5, 'resource_url': f'{url}/5.json' }
+  ]
+  with open(api / 'master.json', 'w') as f:
+    json.dump({ 'pagination': { 'urls': { 'next': f'{url}/master2.json' } }, 'versions': versions[:2] }, f)
+  with open(api / 'master2.json', 'w') as f:
+    json.dump({ 'pagination': { 'urls': {} }, 'versions': versions[2:] }, f)
+  dir = tmp_path / 'Album'
+  dir.mkdir()
+  make_album(dir, 'CD1', 2, None)
+  make_album(dir, 'CD2', 2, None)
+
+  mocker.patch('discogs_tag.cli.DISCOGS_RATE_LIMIT', 3)
+  mocker.patch('discogs_tag.cli.DISCOGS_RATE_WINDOW', 0.1)
+  started = time.perf_counter()
+  tag(master=f'{url}/master.json', dir=str(dir), cache=str(tmp_path / 'cache'))
+  # 7 requests at 3 per window need at least 2 full windows.
+  assert time.perf_counter() - started >= 0.2
+  audio = open_audio(str(dir / 'CD2' / '02.flac'))
+  assert audio['album'] == ['Album']
+  assert audio['title'] == ['Track 2-2']
+  assert audio['discnumber'] == ['2']
+  assert sorted(requests) == ['/1.json', '/2.json', '/3.json', '/4.json', '/5.json', '/master.json', '/master2.json']
+
+  # Versions are cached, only the version list is fetched again.
+  requests.clear()
+  tag(master=f'{url}/master.json', dir=str(dir), cache=str(tmp_path / 'cache'))
+  assert sorted(requests) == ['/5.json', '/master.json', '/master2.json']
+
+  # Expired versions are fetched again.
+  requests.clear()
+  for file in os.listdir(tmp_path / 'cache' / 'releases'):
+    os.utime(tmp_path / 'cache' / 'releases' / file, (0, 0))
+  tag(master=f'{url}/master.json', dir=str(dir), cache=str(tmp_path / 'cache'))
+  assert sorted(requests) == ['/1.json', '/2.json', '/3.json', '/4.json', '/5.json', '/master.json', '/master2.json']
+
+  # Errors on full URLs are not retried against the Discogs API.
+  requests.clear()
+  with pytest.raises(urllib.error.HTTPError):
+    get_master(f'{url}/missing.json')
+  assert requests == ['/missing.json']
+  requests.clear()
+  with pytest.raises(urllib.error.HTTPError):
+    get_release(f'{url}/missing.json')
+  assert requests == ['/missing.json']
+
+  with pytest.raises(Exception) as error:
+    tag(dir=str(dir))
+  assert 'Expecting a RELEASE or a MASTER' in str(error.value)
+
+def test_pick_version(tmp_path):
+  files = [make_audio(tmp_path / f'0{n}.flac', n) for n in range(1, 4)]
+  lengths = [open_audio(file).info.length for file in files]
+  options = parse_options({ 'dry': True })
+  versions = [
+    { 'id': 1, 'tracklist': [{ 'type_': 'track', 'position': str(n), 'duration': '' } for n in range(1, 4)] },
+    { 'id': 2, 'tracklist': [{ 'type_': 'track', 'position': str(n), 'duration': f'0:0{4 - n}' } for n in range(1, 4)] },
+    { 'id': 3, 'tracklist': [{ 'type_': 'track', 'position': str(n), 'duration': f'0:0{n}' } for n in range(1, 4)] },
+    { 'id': 4, 'tracklist': [{ 'type_': 'track', 'position': str(n), 'duration': f'0:0{n}' } for n in range(1, 5)] }
+  ]
+  assert pick_version(versions, files, lengths, options)['id'] == 3
+  assert pick_version(versions[:2], files, lengths, options)['id'] == 2
+  assert pick_version(versions[:1], files, lengths, options)['id'] == 1
+
+def test_rename_recreated_dirs(tmp_path):
+  # The destination of a later file is a source folder that was emptied and removed earlier.
+  src = tmp_path / 'Artist'
+  for path, album, genre in [('A/X/01.flac', 'C', 'D'), ('M/01.flac', 'A', 'X')]:
+    (src / path).parent.mkdir(parents=True, exist_ok=True)
+    audio = open_audio(make_audio(src / path))
+    audio.update({ 'albumartist': 'Artist', 'album': album, 'genre': genre, 'tracknumber': '1' })
+    audio.save()
+
+  rename('%z/%b/%g/%n', dir=str(src))
+  assert os.path.exists(src / 'C' / 'D' / '01.flac')
+  assert os.path.exists(src / 'A' / 'X' / '01.flac')
+  assert not os.path.exists(src / 'M')